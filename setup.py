@@ -12,6 +12,7 @@ setup(
     package_dir={'': 'src'},
     packages=find_packages('src'),
     license = 'Apache',
-    scripts=['src/sbin/lbproxyd', 'src/sbin/lbproxy-collector'],
+    scripts=['src/sbin/lbproxyd', 'src/sbin/lbproxy-collector',
+             'src/sbin/lbproxy-dbmigrate', 'src/sbin/lbproxy-worker'],
     data_files=[('/etc/lbproxy', ['src/etc/lbproxy.cfg'])],
 )
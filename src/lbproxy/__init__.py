@@ -12,12 +12,17 @@
 #
 # @author: Juliano Martinez (ncode)
 
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from sqlalchemy.exc import IntegrityError
 
-from .connection import connect_to_f5
+from .connection import f5_connection
+from . import nodeindex, snapshot, watch
 from .db import models, db_utils
 from .utils import (
-    config, has_attr, get_logger
+    config, has_attr, get_logger, invalidate_tags, poolmember_tags
 )
 from .exceptions import (
     PoolMemberDoesNotExist, NodeDoesNotExist, OperationNotPermited
@@ -25,7 +30,198 @@ from .exceptions import (
 
 
 logger = get_logger()
-session = db_utils.get_database_session()
+# Thread local, removed after every request and collector run
+session = db_utils.get_scoped_session()
+
+
+def _query(*fields, **filters):
+    """Query poolmembers by the names of their device, pool, node..."""
+    return models.query_poolmembers(session, *fields, **filters)
+
+
+def _intern(model, name):
+    """Return the id of a device, partition, pool or node name"""
+    return models.intern_names(session, model, [name])[name]
+
+
+def _use_primary():
+    """Keep the queries of this session on the primary database
+
+    Called before a mutation, later reads of the same request see it.
+    """
+    session.info['force_primary'] = True
+
+
+def _status_query(**filters):
+    """Join poolmembers with their properties, filtered by names"""
+    return _query(
+        'partition', 'pool', 'nodename', models.PoolMemberProperty.status,
+        **filters
+    ).join(
+        models.PoolMemberProperty,
+        models.PoolMemberProperty.poolmember_id == models.PoolMember.id
+    )
+
+
+def _snapshot(device):
+    """The snapshot answering reads of a device, None to read from SQL"""
+    if device is None or not snapshot.is_enabled() or \
+            session.info.get('force_primary'):
+        return None
+    return snapshot.get_device(device)
+
+
+# device -> [added, removed, events] of the changes to propagate once the
+# publishing() block of a thread ends
+_deferred = threading.local()
+
+
+@contextmanager
+def publishing():
+    """Propagate the changes made inside the block once per device, at
+    its end"""
+    if getattr(_deferred, 'changes', None) is not None:
+        yield
+        return
+    _deferred.changes = OrderedDict()
+    try:
+        yield
+    finally:
+        changes, _deferred.changes = _deferred.changes, None
+        for device, (added, removed, events) in changes.items():
+            _propagate(device, list(added.values()), list(removed.values()),
+                       events)
+
+
+def _propagate(device, added, removed, events):
+    # Readers refilling the caches dropped below must find the new
+    # snapshot, it is published first
+    nodeindex.update(device, added, removed)
+    if snapshot.is_enabled():
+        try:
+            snapshot.apply(device, added, removed)
+        except Exception as e:
+            logger.error('Publishing the snapshot of {} failed: {}'.format(
+                device, e
+            ))
+    invalidate_tags([
+        tag for member in added + removed
+        for tag in poolmember_tags(device, member[0], member[1])
+    ])
+    if events:
+        watch.publish(device, events)
+
+
+def _changed(device, added=(), removed=(), watched=True):
+    """Propagate committed changes of poolmembers of a device
+
+    added holds (pool, node, port, enabled) of created or updated members
+    and removed (pool, node) of deleted ones. The node index and the
+    snapshot are updated, then cached answers covering them invalidated
+    and watchers told. watched is False when no state changed, or the
+    (pool, node, enabled) events to send instead of one per member.
+    """
+    added = list(added)
+    removed = list(removed)
+    if watched is True:
+        watched = [(member[0], member[1], member[3]) for member in added] + \
+            [(member[0], member[1], None) for member in removed]
+    events = list(watched or [])
+
+    changes = getattr(_deferred, 'changes', None)
+    if changes is None:
+        _propagate(device, added, removed, events)
+        return
+    pending_added, pending_removed, pending_events = changes.setdefault(
+        device, (OrderedDict(), OrderedDict(), []))
+    for member in removed:
+        pending_added.pop(tuple(member[:2]), None)
+        pending_removed[tuple(member[:2])] = member
+    for member in added:
+        pending_removed.pop(tuple(member[:2]), None)
+        pending_added[tuple(member[:2])] = member
+    pending_events.extend(events)
+
+
+def _names(field, **filters):
+    """Distinct names of one dimension among the matching poolmembers"""
+    snap = _snapshot(filters.get('device'))
+    if snap is not None:
+        return snap.names(field, **filters)
+    return [row[0] for row in _query(field, **filters).distinct()]
+
+
+def locate_nodes(nodes):
+    """Locate the poolmembers of many nodes
+
+    Returns {node: [(device, partition, pool, port, enabled), ...]} from
+    the node index; the devices it has no complete entries of are read
+    from the database.
+    """
+    nodes = list(nodes)
+    located = nodeindex.lookup(nodes)
+    complete = nodeindex.built()
+    missing = [name for name, in session.query(models.Device.name)
+               if name not in complete]
+    if not (missing and nodes):
+        return located
+
+    logger.debug('Locating nodes of {} in the database'.format(missing))
+    for node in located:
+        located[node] = [location for location in located[node]
+                         if location[0] in complete]
+    pmp = models.PoolMemberProperty
+    query = _query(
+        'device', 'partition', 'pool', 'nodename', pmp.port, pmp.status
+    ).join(pmp, pmp.poolmember_id == models.PoolMember.id).filter(
+        models.Device.name.in_(missing)
+    )
+    for i in range(0, len(nodes), 500):
+        for device, partition, pool, node, port, status in query.filter(
+                models.Node.name.in_(nodes[i:i + 500])):
+            located[node].append((device, partition, pool, port,
+                                  bool(status)))
+    return located
+
+
+def _locations(node):
+    """(device, partition, pool, port, enabled) of the members of a node"""
+    return locate_nodes([node])[node]
+
+
+def _status_rows(**filters):
+    """(partition, pool, nodename, status) of the matching poolmembers"""
+    snap = _snapshot(filters.get('device'))
+    if snap is not None:
+        return snap.rows(**filters)
+    return _status_query(**filters)
+
+
+def _status_stream(**filters):
+    """_status_rows() ordered by partition, pool and node, iterated over a
+    server side cursor"""
+    snap = _snapshot(filters.get('device'))
+    if snap is not None:
+        return iter(sorted(snap.rows(**filters)))
+    return iter(_status_query(**filters).order_by(
+        models.Partition.name, models.Pool.name, models.Node.name
+    ).yield_per(1000))
+
+
+def _status_tree(rows, depth):
+    """Fold (partition, pool, nodename, status) rows into a nested dict
+
+    depth selects the top level of the answer: 0 for partitions,
+    1 for pools and 2 for poolmembers.
+    """
+    tree = {}
+    for row in rows:
+        status = 'enabled' if row[3] else 'disabled'
+        node = tree
+        for key in row[depth:2]:
+            node = node.setdefault(key, {})
+        node[row[2]] = {"status": status}
+    return tree
 
 
 class Device(object):
@@ -38,10 +234,7 @@ class Device(object):
             self._partition = partition
 
     def exists(self):
-        ss = session.query(models.PoolMember.device).filter_by(
-            device=self.name,
-        ).first()
-        return True if ss else False
+        return True if _names('device', device=self.name) else False
 
     @property
     def partition(self, partition):
@@ -61,28 +254,32 @@ class Device(object):
         self._partition = '/{}'.format(pool.split('/')[1]) if pool else None
 
     def all_poolmembers(self):
-        return {Poolmember(poolmember[0], device=self.name)
-                for poolmember in session.query(
-            models.PoolMember.nodename).filter_by(
-            device=self.name).distinct().all()}
+        return {Poolmember(poolmember, device=self.name)
+                for poolmember in _names(
+            'nodename', device=self.name)}
 
     def pools(self):
-        return {Pool(pool[0], device=self.name) for pool in session.query(
-            models.PoolMember.pool).filter_by(
-            device=self.name).distinct().all()}
+        return {Pool(pool, device=self.name) for pool in _names(
+            'pool', device=self.name)}
 
     @has_attr('_pool', 'You must select a pool first')
     def poolmembers(self):
-        return {Poolmember(poolmember[0], pool=self._pool, device=self.name)
-                for poolmember in session.query(
-            models.PoolMember.nodename).filter_by(
-            device=self.name, pool=self._pool).distinct().all()}
+        return {Poolmember(poolmember, pool=self._pool, device=self.name)
+                for poolmember in _names(
+            'nodename', device=self.name, pool=self._pool)}
 
     def partitions(self):
-        return {Partition(partition[0], device=self.name)
-                for partition in session.query(
-            models.PoolMember.partition).filter_by(
-            device=self.name).distinct().all()}
+        return {Partition(partition, device=self.name)
+                for partition in _names(
+            'partition', device=self.name)}
+
+    def status_tree(self):
+        """Status of every poolmember on the device, in a single query"""
+        return _status_tree(_status_rows(device=self.name), 0)
+
+    def status_stream(self):
+        """Ordered status rows of every poolmember on the device"""
+        return _status_stream(device=self.name)
 
 
 class Partition(object):
@@ -102,55 +299,64 @@ class Partition(object):
         self._device = device
 
     def all_pools(self):
-        return {pool[0] for pool in session.query(
-            models.PoolMember.pool).filter_by(
-            partition=self.name).distinct().all()}
+        return set(_names('pool', partition=self.name))
 
     def all_poolmembers(self, pool=None):
         if pool:
-            return session.query(models.PoolMember.nodename).filter_by(
-                partition=self.name, pool=pool).distinct().all()
-        return session.query(models.PoolMember.nodenames).filter_by(
-            partition=self.name).distinct(models.PoolMember.nodenames).all()
+            return _query(
+                'nodename', partition=self.name, pool=pool).distinct().all()
+        return _query(
+            'nodename', partition=self.name).distinct().all()
 
     @has_attr('_device', 'You must select a device first')
     def pools(self):
-        return {Pool(pool[0], device=self._device)
-                for pool in session.query(
-            models.PoolMember.pool).filter_by(
-            device=self._device, partition=self.name).distinct().all()}
+        return {Pool(pool, device=self._device)
+                for pool in _names(
+            'pool', device=self._device,
+            partition=self.name)}
 
     @has_attr('_device', 'You must select a device first')
     def poolmembers(self):
-        return {Poolmember(poolmember[0], device=self._device)
-                for poolmember in session.query(
-            models.PoolMember.nodename).filter_by(
-            device=self._device, partition=self.name).distinct().all()}
+        return {Poolmember(poolmember, device=self._device)
+                for poolmember in _names(
+            'nodename', device=self._device,
+            partition=self.name)}
 
     def devices(self):
-        return {Device(device[0]) for device in session.query(
-            models.PoolMember.devices).filter_by(
-            partition=self.name).distinct().all()}
+        return {Device(device) for device in _names(
+            'device', partition=self.name)}
+
+    @has_attr('_device', 'You must select a device first')
+    def status_tree(self):
+        """Status of every poolmember in the partition, in a single query"""
+        return _status_tree(
+            _status_rows(device=self._device, partition=self.name), 1)
+
+    @has_attr('_device', 'You must select a device first')
+    def status_stream(self):
+        """Ordered status rows of every poolmember in the partition"""
+        return _status_stream(device=self._device, partition=self.name)
 
     @has_attr('_device', 'You must select a device first')
     def exists(self):
-        ss = session.query(models.PoolMember.partition).filter_by(
-            device=self._device,
-            partition=self.name,
-        ).first()
+        ss = _names('partition', device=self._device, partition=self.name)
         return True if ss else False
 
     @has_attr('_device', 'You must select a device first')
     def delete(self):
+        removed = []
         session.begin(subtransactions=True)
         try:
-            for ss in session.query(models.PoolMember).filter_by(
+            for ss, pool, nodename in _query(
+                    models.PoolMember, 'pool', 'nodename',
                     device=self._device, partition=self.name).all():
+                removed.append((pool, nodename))
                 session.delete(ss)
             session.commit()
         except Exception as err:
             session.rollback()
             raise Exception(err)
+        _changed(self._device, removed=removed)
         logger.debug("Partition has been deleted: {}/{}/{}".format(
             self._device, self._partition, self.name
         ))
@@ -167,43 +373,48 @@ class Pool(object):
         self._device = device
 
     def devices(self):
-        return {Device(device[0], pool=self._pool)
-                for device in session.query(
-            models.PoolMember.device).filter_by(
-            pool=self.name).distinct().all()}
+        return {Device(device, pool=self._pool)
+                for device in _names(
+            'device', pool=self.name)}
 
     @has_attr('_device', 'You must select a device first')
     def exists(self):
-        ss = session.query(models.PoolMember.pool).filter_by(
-            device=self._device,
-            pool=self.name,
-        ).first()
+        ss = _names('pool', device=self._device, pool=self.name)
         return True if ss else False
 
     def all_poolmembers(self):
-        return {Poolmember(poolmember[0])
-                for poolmember in session.query(
-            models.PoolMember.nodename).filter_by(
-            pool=self.name).distinct().all()}
+        return {Poolmember(poolmember)
+                for poolmember in _names(
+            'nodename', pool=self.name)}
+
+    @has_attr('_device', 'You must select a device first')
+    def status_tree(self):
+        """Status of every poolmember in the pool, in a single query"""
+        return _status_tree(
+            _status_rows(device=self._device, pool=self.name), 2)
 
     @has_attr('_device', 'You must select a device first')
     def poolmembers(self):
-        return {Poolmember(poolmember[0], pool=self.name, device=self._device)
-                for poolmember in session.query(
-            models.PoolMember.nodename).filter_by(
-            device=self._device, pool=self.name).distinct().all()}
+        return {Poolmember(poolmember, pool=self.name, device=self._device)
+                for poolmember in _names(
+            'nodename', device=self._device,
+            pool=self.name)}
 
     @has_attr('_device', 'You must select a device first')
     def delete(self):
+        removed = []
         session.begin(subtransactions=True)
         try:
-            for ss in session.query(models.PoolMember).filter_by(
+            for ss, nodename in _query(
+                    models.PoolMember, 'nodename',
                     device=self._device, pool=self.name).all():
+                removed.append((self.name, nodename))
                 session.delete(ss)
             session.commit()
         except Exception as err:
             session.rollback()
             raise Exception(err)
+        _changed(self._device, removed=removed)
         logger.debug("Pool has been deleted: {}/{}/{}".format(
             self._device, self._partition, self.name
         ))
@@ -228,6 +439,7 @@ class Poolmember(object):
         self._device = device
         self._partition = '/{}'.format(pool.split('/')[1]) if pool else None
         self._skip_f5 = False
+        self._ss = None
 
     @property
     def partition(self, partition):
@@ -236,6 +448,7 @@ class Poolmember(object):
     @partition.setter
     def partition(self, partition):
         self._partition = partition
+        self._ss = None
 
     @property
     def pool(self):
@@ -245,6 +458,7 @@ class Poolmember(object):
     def pool(self, pool):
         self._pool = pool
         self._partition = '/{}'.format(pool.split('/')[1]) if pool else None
+        self._ss = None
 
     @property
     def device(self, device):
@@ -253,28 +467,62 @@ class Poolmember(object):
     @device.setter
     def device(self, device):
         self._device = device
+        self._ss = None
 
     @has_attr('_device', 'You must select a device first')
     @has_attr('_pool', 'You must select a pool first')
     def _exists(self):
-        ss = session.query(models.PoolMember).filter_by(
-            device=self._device,
-            partition=self._partition,
-            pool=self._pool,
-            nodename=self.name
-        )
-        return ss.first() if ss else None
+        # The row and its eagerly loaded properties are kept for the
+        # lifetime of the object, repeated reads do not query again
+        if self._ss is None:
+            self._ss = _query(
+                models.PoolMember,
+                device=self._device,
+                partition=self._partition,
+                pool=self._pool,
+                nodename=self.name
+            ).first()
+        return self._ss
+
+    def _property(self):
+        ss = self._exists()
+        if not ss:
+            raise PoolMemberDoesNotExist(
+                "Poolmember not found: {}/{}/{}/{}".format(
+                    self._device, self._partition, self._pool, self.name
+                )
+            )
+        return ss.poolmemberproperty[0]
+
+    def _read(self):
+        """The port and status of the poolmember from the read backend"""
+        snap = _snapshot(self._device)
+        if snap is None:
+            return self._property()
+        member = snap.member(self._pool, self.name)
+        if member is None:
+            raise PoolMemberDoesNotExist(
+                "Poolmember not found: {}/{}/{}/{}".format(
+                    self._device, self._partition, self._pool, self.name
+                )
+            )
+        return member
 
     @has_attr('_device', 'You must select a device first')
     @has_attr('_pool', 'You must select a pool first')
     def create(self, port, status):
+        _use_primary()
+        device_id = _intern(models.Device, self._device)
+        partition_id = _intern(models.Partition, self._partition)
+        pool_id = _intern(models.Pool, self._pool)
+        node_id = _intern(models.Node, self.name)
         session.begin(subtransactions=True)
         try:
             session.add(models.PoolMember(
-                device=self._device,
-                partition=self._partition,
-                pool=self._pool,
-                nodename=self.name,
+                device_id=device_id,
+                partition_id=partition_id,
+                pool_id=pool_id,
+                node_id=node_id,
             ))
             session.commit()
         except IntegrityError:
@@ -290,6 +538,7 @@ class Poolmember(object):
             self._device, self._partition, self._pool, self.name
         ))
 
+        self._ss = None
         ss = self._exists()
 
         session.begin(subtransactions=True)
@@ -310,6 +559,8 @@ class Poolmember(object):
         except Exception as err:
             session.rollback()
             raise Exception(err)
+        session.expire(ss, ['poolmemberproperty'])
+        _changed(self._device, added=[(self._pool, self.name, port, status)])
         logger.debug(
             "PoolMemberProperties have been created: {}/{}/{}/{}".format(
                 self._device, self._partition, self._pool, self.name
@@ -318,6 +569,7 @@ class Poolmember(object):
     @has_attr('_device', 'You must select a device first')
     @has_attr('_pool', 'You must select a pool first')
     def delete(self):
+        _use_primary()
         ss = self._exists()
         session.begin(subtransactions=True)
         try:
@@ -326,95 +578,70 @@ class Poolmember(object):
         except Exception as err:
             session.rollback()
             raise Exception(err)
+        self._ss = None
+        _changed(self._device, removed=[(self._pool, self.name)])
         logger.debug("Poolmember has been deleted: {}/{}/{}/{}".format(
             self._device, self._partition, self._pool, self.name
         ))
         return True
 
     def pools(self):
-        return {Pool(pool[0]) for pool in session.query(
-            models.PoolMember.pool).filter_by(
-            nodename=self.name).distinct().all()}
+        return {Pool(location[2]) for location in _locations(self.name)}
 
     def devices(self):
-        return {Device(device[0]) for device in session.query(
-            models.PoolMember.device).filter_by(
-            nodename=self.name).distinct().all()}
+        return {Device(location[0]) for location in _locations(self.name)}
 
     def partitions(self):
-        return {Partition(partition[0]) for partition in session.query(
-            models.PoolMember.partition).filter_by(
-            nodename=self.name).distinct().all()}
+        return {Partition(location[1])
+                for location in _locations(self.name)}
 
     @has_attr('_device', 'You must select a device first')
     @has_attr('_pool', 'You must select a pool first')
     def exists(self):
+        snap = _snapshot(self._device)
+        if snap is not None:
+            return snap.member(self._pool, self.name) is not None
         ss = self._exists()
         return True if ss else False
 
     @has_attr('_device', 'You must select a device first')
     @has_attr('_pool', 'You must select a pool first')
     def port(self):
-        ss = self._exists()
-        if not ss:
-            raise PoolMemberDoesNotExist(
-                "Poolmember not found: {}/{}/{}/{}".format(
-                    self._device, self._partition, self._pool, self.name
-                )
-            )
-
-        st = session.query(models.PoolMemberProperty).filter_by(
-            poolmember_id=ss.id).first()
-        return st.port
+        return self._read().port
 
     @property
     @has_attr('_device', 'You must select a device first')
     @has_attr('_pool', 'You must select a pool first')
     def enabled(self):
-        ss = self._exists()
-        if not ss:
-            raise PoolMemberDoesNotExist(
-                "Poolmember not found: {}/{}/{}/{}".format(
-                    self._device, self._partition, self._pool, self.name
-                )
-            )
-
-        st = session.query(models.PoolMemberProperty).filter_by(
-            poolmember_id=ss.id).first()
-        return st.status
+        return self._read().status
 
     @enabled.setter
     @has_attr('_device', 'You must select a device first')
     @has_attr('_pool', 'You must select a pool first')
     def enabled(self, state):
-        ss = self._exists()
-        if not ss:
-            raise PoolMemberDoesNotExist(
-                "Poolmember not found: {}/{}/{}/{}".format(
-                    self._device, self._partition, self._pool, self.name
-                )
-            )
-
-        st = session.query(models.PoolMemberProperty
-                           ).filter_by(poolmember_id=ss.id).first()
+        _use_primary()
+        st = self._property()
+        previous = bool(st.status)
         session.begin(subtransactions=True)
         try:
-            st.status = True
-            session.commit()
+            st.status = state
 
             if not self._skip_f5:
-                asasaa
-                lb = connect_to_f5(self._device)
-                pm = lb.pm_get(
-                    lb.node_get(self.name),
-                    self.port(),
-                    lb.pool_get(self._pool)
-                )
-                pm.enabled = state
+                with f5_connection(self._device) as lb:
+                    pm = lb.pm_get(
+                        lb.node_get(self.name),
+                        st.port,
+                        lb.pool_get(self._pool)
+                    )
+                    pm.enabled = state
 
+            session.commit()
         except Exception as err:
             session.rollback()
             raise Exception(err)
+        _changed(self._device,
+                 added=[(self._pool, self.name, st.port, state)],
+                 watched=previous != bool(state))
         logger.debug("Poolmember has been enabled: {}/{}/{}/{}".format(
             self._device, self._partition, self._pool, self.name
         ))
@@ -447,26 +674,22 @@ class Node(object):
 
     @has_attr('_device', 'You must select a device first')
     def _exists(self):
-        ss = session.query(models.PoolMember).filter_by(
+        ss = _query(
+            models.PoolMember,
             device=self._device,
             nodename=self.name
         )
         return ss.first() if ss else None
 
     def pools(self):
-        return {Pool(pool[0]) for pool in session.query(
-            models.PoolMember.pool).filter_by(
-            nodename=self.name).distinct().all()}
+        return {Pool(location[2]) for location in _locations(self.name)}
 
     def devices(self):
-        return {Device(device[0]) for device in session.query(
-            models.PoolMember.device).filter_by(
-            nodename=self.name).distinct().all()}
+        return {Device(location[0]) for location in _locations(self.name)}
 
     def partitions(self):
-        return {Partition(partition[0]) for partition in session.query(
-            models.PoolMember.partition).filter_by(
-            nodename=self.name).distinct().all()}
+        return {Partition(location[1])
+                for location in _locations(self.name)}
 
     @has_attr('_device', 'You must select a device first')
     def exists(self):
@@ -484,9 +707,9 @@ class Node(object):
                 )
             )
 
-        lb = connect_to_f5(self._device)
-        nd = lb.node_get(self.name)
-        return nd.enabled
+        with f5_connection(self._device) as lb:
+            nd = lb.node_get(self.name)
+            return nd.enabled
 
     @enabled.setter
     @has_attr('_device', 'You must select a device first')
@@ -499,16 +722,19 @@ class Node(object):
                 )
             )
 
-        pm = Poolmember(self.name, self._device)
-        pm.skip_f5 = self.skip_f5
-
-        for pool in pm.pools():
-            pm.pool = pool.name
-            pm.enabled = state
-
-        lb = connect_to_f5(self._device)
-        nd = lb.node_get(self.name)
-        nd.enabled = state
+        # Imported here, coalesce builds on this module
+        from . import coalesce
+        with publishing():
+            for device, partition, pool, port, enabled in \
+                    _locations(self.name):
+                if device != self._device:
+                    continue
+                coalesce.submit(self._device, pool, self.name, state,
+                                skip_f5=self.skip_f5)
+
+        with f5_connection(self._device) as lb:
+            nd = lb.node_get(self.name)
+            nd.enabled = state
 
     @property
     def skip_f5(self):
@@ -13,28 +13,84 @@
 # @author: Juliano Martinez (ncode)
 
 import configparser
+import hashlib
+import hmac
+import os
+import threading
+import time
 
-from lbproxy.utils import get_logger
+from lbproxy.utils import clear_auth_cache, get_logger
 
 logger = get_logger()
 
 
 class Auth(object):
-    def do(self, request):
+    """Check X-Beam-User and X-Beam-Key against /etc/lbproxy/auth.cfg
+
+    The keys are held in memory as salted hashes and compared in constant
+    time. The file is read again when its mtime changes, checked at most
+    every check_interval seconds, or when reload() is called.
+    """
+
+    config_file = '/etc/lbproxy/auth.cfg'
+    check_interval = 1
+
+    def __init__(self):
+        self._salt = os.urandom(16)
+        self._keys = {}
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _hash(self, key):
+        return hmac.new(self._salt, key.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def _stat(self):
         try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        with self._lock:
+            mtime = self._stat()
             config = configparser.ConfigParser()
-            config_file = '/etc/lbproxy/auth.cfg'
-            config.read(config_file)
+            config.read(self.config_file)
+            keys = {}
+            if config.has_section('lbproxy'):
+                keys = {username: self._hash(key)
+                        for username, key in config.items('lbproxy')}
+            self._keys = keys
+            self._mtime = mtime
+            self._checked = time.time()
+        clear_auth_cache()
+        logger.info('Loaded %d users from %s' % (len(keys), self.config_file))
+
+    def _check(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        if self._stat() != self._mtime:
+            self.reload()
+
+    def do(self, request):
+        try:
             username = request.headers.get('X-Beam-User')
             key = request.headers.get('X-Beam-Key')
             if username == None or key == None:
                 logger.info('Missing X-Beam-User or X-Beam-Key headers')
                 return False
 
-            logger.error('Authenticating user %s' % username)
-            if config.get('lbproxy', username) == key:
-                return True
-            else:
+            logger.debug('Authenticating user %s' % username)
+            self._check()
+            # Option names of the file are lower cased
+            expected = self._keys.get(username.lower())
+            if expected is None:
                 return False
+            return hmac.compare_digest(self._hash(key), expected)
         except Exception as e:
             logger.error('Problem authenticating: %s' % e.__str__())
+            return False
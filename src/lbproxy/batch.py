@@ -0,0 +1,281 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Apply many poolmember and node state changes at once
+
+Changes are expanded to poolmembers, grouped by device and pool and
+written to the loadbalancers concurrently, one pooled F5 session per
+pool. Every pool goes through coalesce so that concurrent changes of the
+same poolmembers collapse to the latest one, and its database side is
+committed in one transaction once its F5 writes are done, only for the
+poolmembers the F5 accepted.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from sqlalchemy import bindparam
+
+from .connection import f5_connection
+from .db import models
+from .utils import get_config, get_logger
+from . import _changed, _use_primary, coalesce, locate_nodes, session
+
+logger = get_logger()
+
+
+def _name(name, prefix='/Common'):
+    return name if name.startswith('/') else '{}/{}'.format(prefix, name)
+
+
+def validate(items):
+    """Raise ValueError unless items is a list of valid changes"""
+    if not isinstance(items, list) or not items:
+        raise ValueError('changes must be a non empty list')
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError('every change must be an object')
+        if item.get('status') not in ('enabled', 'disabled'):
+            raise ValueError('status must be enabled or disabled')
+        if 'node' in item:
+            continue
+        for key in ('loadbalancer', 'partition', 'pool', 'poolmember'):
+            if not item.get(key):
+                raise ValueError(
+                    '{} is missing from a poolmember change'.format(key))
+
+
+def _expand(items):
+    """Return [(item index, device, pool, node, state)] of every change
+
+    Poolmember items name a loadbalancer, partition, pool and poolmember;
+    node items name a node and optionally the loadbalancer to limit the
+    change to, their poolmembers are found in the node index.
+    """
+    members = []
+    nodes = {}
+    for i, item in enumerate(items):
+        state = item['status'] == 'enabled'
+        if 'node' in item:
+            nodes.setdefault(_name(item['node']), []).append((i, state))
+        else:
+            members.append((
+                i, item['loadbalancer'],
+                '/{}/{}'.format(item['partition'], item['pool']),
+                _name(item['poolmember']), state
+            ))
+
+    for node, locations in locate_nodes(nodes).items():
+        for i, state in nodes[node]:
+            device = items[i].get('loadbalancer')
+            members.extend(
+                (i, location[0], location[2], node, state)
+                for location in locations
+                if device is None or location[0] == device
+            )
+    return members
+
+
+def devices(items):
+    """Loadbalancers the changes of a batch write to
+
+    Node items naming no loadbalancer are looked up in the node index.
+    """
+    return {device for i, device, pool, node, state in _expand(items)}
+
+
+def _current(device, members):
+    """Map (pool, node) of the given members to (property id, port, status)"""
+    pmp = models.PoolMemberProperty
+    query = models.query_poolmembers(
+        session, 'pool', 'nodename', pmp.id, pmp.port, pmp.status,
+        device=device
+    ).join(pmp, pmp.poolmember_id == models.PoolMember.id)
+    pools = sorted({pool for pool, node in members})
+    current = {}
+    for i in range(0, len(pools), 500):
+        current.update(((row[0], row[1]), row[2:]) for row in query.filter(
+            models.Pool.name.in_(pools[i:i + 500])).all())
+    return current
+
+
+def _set_states(device, pool, changes):
+    """Write {node: state} members of one pool, return (result, error)
+
+    The members the F5 accepted are stored in one transaction.
+    """
+    current = _current(device, [(pool, node) for node in changes])
+    outcome = {}
+    writes = []
+    for node, state in changes.items():
+        if (pool, node) not in current:
+            outcome[node] = ('not_found', None)
+        elif bool(current[(pool, node)][2]) == state:
+            outcome[node] = ('unchanged', None)
+        else:
+            writes.append((node, state))
+    if not writes:
+        return outcome
+
+    written = []
+    with f5_connection(device) as lb:
+        f5_pool = lb.pool_get(pool)
+        for node, state in writes:
+            pmp_id, port = current[(pool, node)][:2]
+            try:
+                pm = lb.pm_get(lb.node_get(node), port, f5_pool)
+                pm.enabled = state
+            except Exception as err:
+                outcome[node] = ('error', repr(err))
+            else:
+                written.append((pool, node, pmp_id, port, state))
+    if not written:
+        return outcome
+
+    try:
+        _commit(device, written)
+        result = ('ok', None)
+    except Exception as err:
+        logger.error('Storing the batch changes of {}{} failed: {}'.format(
+            device, pool, err
+        ))
+        result = ('error', repr(err))
+    for member in written:
+        outcome[member[1]] = result
+    return outcome
+
+
+def _write_pool(device, pool, states):
+    """Bring {node: state} members of one pool to their state
+
+    Runs in a worker thread, with a database session of its own.
+    """
+    try:
+        return coalesce.submit_many(
+            device, pool, states,
+            lambda changes: _set_states(device, pool, changes))
+    finally:
+        session.remove()
+
+
+def _write_node(device, node, state):
+    with f5_connection(device) as lb:
+        lb.node_get(node).enabled = state
+
+
+def _commit(device, written):
+    """Store the states of (pool, node, property id, port, state) members"""
+    table = models.PoolMemberProperty.__table__
+    session.begin(subtransactions=True)
+    try:
+        session.execute(table.update().where(
+            table.c.id == bindparam('_id')
+        ).values(status=bindparam('_status')), [
+            {'_id': pmp_id, '_status': state}
+            for pool, node, pmp_id, port, state in written
+        ])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    _changed(device, added=[(pool, node, port, state)
+                            for pool, node, pmp_id, port, state in written])
+
+
+@contextmanager
+def _no_slot(wanted):
+    yield wanted
+
+
+def apply(items, slot=_no_slot):
+    """Apply the changes of a batch, return one result per item
+
+    Every result repeats its item with a "result" of "ok", "unchanged",
+    "not_found" or "error"; node items also list the result of each of
+    their poolmembers. When several items change the same poolmember or
+    node the last one wins. slot(wanted) is entered around the F5 writes
+    and gives how many of the batch_workers they may run at the same
+    time, for admission control.
+    """
+    _use_primary()
+    members = _expand(items)
+    results = [dict(item, result='not_found') for item in items]
+    outcome = {}
+
+    # (device, pool) -> {node: state} of its poolmembers
+    pools = {}
+    for i, device, pool, node, state in members:
+        pools.setdefault((device, pool), {})[node] = state
+    # (device, node) -> state of the node itself, and the node items
+    # asking for it
+    node_writes = {}
+    node_items = {}
+    for i, device, pool, node, state in members:
+        if 'node' in items[i]:
+            node_writes[(device, node)] = state
+            node_items.setdefault((device, node), set()).add(i)
+
+    futures = {}
+    node_futures = {}
+    workers = min(get_config('lbproxyd', 'batch_workers', 16, cast=int),
+                  len(pools) + len(node_writes))
+    if workers:
+        with slot(workers) as workers, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {key: executor.submit(_write_pool, key[0], key[1],
+                                            value)
+                       for key, value in pools.items()}
+            node_futures = {key: executor.submit(_write_node, key[0], key[1],
+                                                 state)
+                            for key, state in node_writes.items()}
+
+    for (device, pool), future in futures.items():
+        try:
+            pool_results = future.result()
+        except Exception as err:
+            pool_results = {node: ('error', None, repr(err))
+                            for node in pools[(device, pool)]}
+        for node, (result, state, error) in pool_results.items():
+            # Another change of the poolmember took this one over
+            if result == 'coalesced':
+                result = 'ok'
+            outcome[(device, pool, node)] = (result, error)
+
+    for i, device, pool, node, state in members:
+        result, error = outcome[(device, pool, node)]
+        if 'node' in items[i]:
+            member = {'loadbalancer': device, 'pool': pool, 'result': result}
+            if error:
+                member['error'] = error
+            results[i].setdefault('poolmembers', []).append(member)
+        else:
+            results[i]['result'] = result
+            if error:
+                results[i]['error'] = error
+
+    for key, future in node_futures.items():
+        error = future.exception()
+        if error:
+            for i in node_items[key]:
+                results[i].setdefault('errors', []).append(
+                    '{}: {}'.format(key[0], repr(error)))
+
+    for result in results:
+        if 'poolmembers' in result:
+            states = {member['result'] for member in result['poolmembers']}
+            if 'error' in states or result.get('errors'):
+                result['result'] = 'error'
+            elif 'ok' in states:
+                result['result'] = 'ok'
+            else:
+                result['result'] = states.pop()
+    return results
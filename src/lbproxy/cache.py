@@ -13,11 +13,17 @@
 # @author: Juliano Martinez (ncode)
 # @author: Dan Achim (dan@hostatic.ro)
 
-from .utils import (
-    config, get_logger, get_redis
-)
+import hashlib
+import json
+
+from sqlalchemy import bindparam
 
-from . import Device, Poolmember, Partition, Pool
+from .db import models
+from .utils import config, get_logger, get_redis
+
+from . import (
+    Device, Poolmember, Partition, Pool, _changed, nodeindex, session
+)
 
 logger = get_logger()
 ttl = config.get('lbproxyd', 'redis_ttl')
@@ -54,46 +60,225 @@ def cache_virtualserver(device, virtualservers):
     del virtualservers
 
 
-def partitions(device, partitions):
-    """Create and manage the cache namespaces for partitions"""
-    logger.debug('Caching partitions data from %s' % device)
-    device = Device(device)
-
-    for partition in device.partitions():
-        logger.info('Cleaning data from partition %s' % partition)
-        if partition.name not in partitions:
-            partition.delete()
-
-def pools(device, pools):
-    """Create and manage the cache namespaces for pools"""
-    logger.debug('Caching pools from %s' % device)
-    device = Device(device)
-
-    for pool in device.pools():
-        logger.info('Cleaning data from pool %s' % pool)
-        if pool.name not in pools:
-           pool.delete()
-
-def poolmembers(device, pool, _poolmembers, failover_state):
-    """Create and manage the cache namespaces for poolmembers"""
-    logger.info('Caching poolmembers data from %s->%s' % (device, pool))
-    active_poolmembers = set()
-    device = Device(device, pool=pool)
-
-    for poolmember, port, enabled in _poolmembers:
-        logger.info('Caching data from poolmember %s' % poolmember)
-        pm = Poolmember(poolmember, pool, device.name)
-        if pm.exists():
-            pm.skip_f5 = True
-            pm.enabled = enabled
-        else:
-            pm.create(port, enabled)
-        active_poolmembers.add(poolmember)
-
-    for poolmember in device.poolmembers():
-        logger.info('Cleaning data from poolmember %s' % poolmember)
-        if poolmember.name not in active_poolmembers:
-            poolmember.delete()
+def _chunks(items, size=500):
+    """Split a list so IN clauses stay below the database parameter limit"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _current_poolmembers(device, scope=None):
+    """Load the cached poolmembers of a device, optionally of some pools"""
+    pm = models.PoolMember
+    pmp = models.PoolMemberProperty
+    query = models.query_poolmembers(
+        session, pm.id, 'pool', 'nodename', pmp.id, pmp.port, pmp.status,
+        device=device
+    ).outerjoin(pmp, pmp.poolmember_id == pm.id)
+    if scope is None:
+        rows = query.all()
+    else:
+        rows = []
+        for pools in _chunks(scope):
+            rows.extend(query.filter(models.Pool.name.in_(pools)).all())
+    return {(row[1], row[2]): (row[0], row[3], row[4], row[5])
+            for row in rows}
+
+
+def _fingerprint(_poolmembers):
+    """Hash the members and states of a pool as returned by the F5"""
+    members = sorted([str(poolmember), str(port), bool(enabled)]
+                     for poolmember, port, enabled in _poolmembers)
+    return hashlib.sha1(json.dumps(members).encode()).hexdigest()
+
+
+def poolmembers(device, pools, full=True):
+    """Reconcile the cached poolmembers of a device with the F5 data
+
+    pools is an iterable of (pool, [(poolmember, port, enabled), ...]) as
+    returned by the loadbalancer. A fingerprint of every pool is kept in
+    redis; when full is False only the pools whose fingerprint changed
+    since the previous run, or which disappeared, are reconciled.
+    Returns the inserted, updated and deleted
+    (pool, poolmember, port, enabled) tuples.
+    """
+    r = get_redis(write=True)
+    nsf = 'beam::lbproxy::fingerprints::%s' % device
+    fingerprints = {}
+    members = []
+
+    def fingerprinted(pools):
+        for pool, _poolmembers in pools:
+            fingerprints[pool] = _fingerprint(_poolmembers)
+            if full:
+                members.extend((pool, poolmember, port, bool(enabled))
+                               for poolmember, port, enabled in _poolmembers)
+            yield pool, _poolmembers
+
+    if full:
+        changes = _sync_poolmembers(device, fingerprinted(pools))
+        # A full sweep also drops node index entries that went stale
+        nodeindex.rebuild(device, members)
+        pipe = r.pipeline()
+        pipe.delete(nsf)
+        if fingerprints:
+            pipe.hmset(nsf, fingerprints)
+        pipe.execute()
+        return changes
+
+    previous = r.hgetall(nsf)
+    changed = [(pool, _poolmembers)
+               for pool, _poolmembers in fingerprinted(pools)
+               if previous.get(pool) != fingerprints[pool]]
+    removed = [pool for pool in previous if pool not in fingerprints]
+    changed.extend((pool, []) for pool in removed)
+    logger.info('{} of {} pools changed on {}'.format(
+        len(changed), len(fingerprints), device
+    ))
+    if not changed:
+        return {'inserted': [], 'updated': [], 'deleted': []}
+
+    changes = _sync_poolmembers(
+        device, changed, scope=[pool for pool, _poolmembers in changed]
+    )
+    pipe = r.pipeline()
+    updated = {pool: fingerprints[pool]
+               for pool, _poolmembers in changed if pool in fingerprints}
+    if updated:
+        pipe.hmset(nsf, updated)
+    if removed:
+        pipe.hdel(nsf, *removed)
+    pipe.execute()
+    return changes
+
+
+def _sync_poolmembers(device, pools, scope=None):
+    """Diff the given pools against the database and apply the changes
+
+    The current state is loaded in one query, the difference is computed
+    in memory and applied with bulk statements in a single transaction.
+    With a scope only the cached members of those pools are considered.
+    """
+    logger.info('Caching poolmembers data from %s' % device)
+    current = _current_poolmembers(device, scope)
+    seen = set()
+    inserts = []
+    updates = []
+    property_inserts = []
+    # (pool, poolmember, enabled) of the members whose state changed
+    changes = []
+
+    for pool, _poolmembers in pools:
+        for poolmember, port, enabled in _poolmembers:
+            key = (pool, poolmember)
+            if key in seen:
+                continue
+            seen.add(key)
+            if key not in current:
+                inserts.append((pool, poolmember, port, bool(enabled)))
+                changes.append((pool, poolmember, bool(enabled)))
+                continue
+            pm_id, pmp_id, _port, _enabled = current[key]
+            if pmp_id is None:
+                property_inserts.append((pm_id, port, bool(enabled)))
+                updates.append((pool, poolmember, port, bool(enabled)))
+                changes.append((pool, poolmember, bool(enabled)))
+            elif _port != port or bool(_enabled) != bool(enabled):
+                updates.append((pool, poolmember, port, bool(enabled)))
+                if bool(_enabled) != bool(enabled):
+                    changes.append((pool, poolmember, bool(enabled)))
+
+    deletes = [(key[0], key[1], value[2], value[3])
+               for key, value in current.items() if key not in seen]
+
+    if not (inserts or updates or deletes):
+        logger.debug('Poolmembers from %s are up to date' % device)
+        return {'inserted': [], 'updated': [], 'deleted': []}
+
+    if inserts:
+        device_id = models.intern_names(
+            session, models.Device, [device])[device]
+        partition_ids = models.intern_names(
+            session, models.Partition,
+            ['/{}'.format(pool.split('/')[1]) for pool, _, _, _ in inserts])
+        pool_ids = models.intern_names(
+            session, models.Pool, [pool for pool, _, _, _ in inserts])
+        node_ids = models.intern_names(
+            session, models.Node, [node for _, node, _, _ in inserts])
+
+    pm_table = models.PoolMember.__table__
+    pmp_table = models.PoolMemberProperty.__table__
+    session.begin(subtransactions=True)
+    try:
+        delete_ids = [current[(pool, poolmember)][0]
+                      for pool, poolmember, port, enabled in deletes]
+        for ids in _chunks(delete_ids):
+            session.execute(pmp_table.delete().where(
+                pmp_table.c.poolmember_id.in_(ids)))
+            session.execute(pm_table.delete().where(pm_table.c.id.in_(ids)))
+
+        property_updates = [
+            {'_id': current[(pool, poolmember)][1],
+             '_port': port, '_status': enabled}
+            for pool, poolmember, port, enabled in updates
+            if current[(pool, poolmember)][1] is not None
+        ]
+        if property_updates:
+            session.execute(pmp_table.update().where(
+                pmp_table.c.id == bindparam('_id')
+            ).values(
+                port=bindparam('_port'), status=bindparam('_status')
+            ), property_updates)
+
+        if inserts:
+            session.execute(pm_table.insert(), [
+                {'device_id': device_id,
+                 'partition_id': partition_ids[
+                     '/{}'.format(pool.split('/')[1])],
+                 'pool_id': pool_ids[pool],
+                 'node_id': node_ids[poolmember]}
+                for pool, poolmember, port, enabled in inserts
+            ])
+            # Map the new rows to their ids, reading only their pools and
+            # nodes rather than the whole device
+            inserted = {}
+            for chunk in _chunks(inserts):
+                inserted.update(
+                    ((row[1], row[2]), row[0]) for row in session.query(
+                        models.PoolMember.id, models.PoolMember.pool_id,
+                        models.PoolMember.node_id
+                    ).filter(
+                        models.PoolMember.device_id == device_id,
+                        models.PoolMember.pool_id.in_(
+                            {pool_ids[pool] for pool, _, _, _ in chunk}),
+                        models.PoolMember.node_id.in_(
+                            {node_ids[node] for _, node, _, _ in chunk})
+                    ).all())
+            property_inserts.extend(
+                (inserted[(pool_ids[pool], node_ids[poolmember])],
+                 port, enabled)
+                for pool, poolmember, port, enabled in inserts
+            )
+
+        if property_inserts:
+            session.execute(pmp_table.insert(), [
+                {'poolmember_id': pm_id, 'port': port, 'status': enabled}
+                for pm_id, port, enabled in property_inserts
+            ])
+        session.commit()
+    except Exception as err:
+        session.rollback()
+        raise Exception(err)
+
+    _changed(device, added=inserts + updates, removed=deletes,
+             watched=changes + [
+                 (pool, poolmember, None)
+                 for pool, poolmember, port, enabled in deletes
+             ])
+    logger.info(
+        'Poolmembers from {} synced: {} inserted, {} updated, {} deleted'
+        .format(device, len(inserts), len(updates), len(deletes))
+    )
+    return {'inserted': inserts, 'updated': updates, 'deleted': deletes}
 
 def cache_orphans(device, nodes):
     """Create and manage the cache namespaces for nodes without pool"""
@@ -0,0 +1,209 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Coalesce concurrent changes of the same poolmember
+
+Every change bumps the generation of its (device, pool, poolmember) in
+redis and records its state as the desired one, the latest one wins. One
+caller at a time holds the lock of the poolmember: when other changes
+arrived while it waited for the lock it waits coalesce_window seconds
+for more, then writes the desired state unless the poolmember already
+has it, records the generation it applied and repeats until the desired
+state stops moving. The other callers return as soon as a generation at
+least as recent as theirs is applied, so flapping a poolmember or
+several clients asking for the same state cost a single F5 write.
+"""
+
+import time
+import uuid
+from contextlib import contextmanager
+
+from .exceptions import WriteTimeout
+from .utils import get_config, get_logger, get_redis
+from . import Poolmember, _use_primary, session
+
+logger = get_logger()
+
+# poolmember -> hash of the last generation asked for and its state
+desired_prefix = 'beam::lbproxy::coalesce::desired::'
+# poolmember -> hash of the last generation written and its state
+applied_prefix = 'beam::lbproxy::coalesce::applied::'
+lock_prefix = 'beam::lbproxy::write_lock::'
+stats_key = 'beam::lbproxy::coalesce_stats'
+
+
+@contextmanager
+def _no_slot():
+    yield
+
+
+def _applied(r, key, generation):
+    """State applied for generation or a later one, None until then"""
+    applied, state = r.hmget(applied_prefix + key, 'generation', 'state')
+    if applied is None or int(applied) < generation:
+        return None
+    return state == '1'
+
+
+def _desired(r, keys, names):
+    """Map names to the (generation, state) last asked for, or None"""
+    pipe = r.pipeline(transaction=False)
+    for name in names:
+        pipe.hmget(desired_prefix + keys[name], 'generation', 'state')
+    return {name: None if generation is None
+            else (int(generation), state == '1')
+            for name, (generation, state) in zip(names, pipe.execute())}
+
+
+def submit_many(device, pool, states, write):
+    """Bring poolmembers of one pool to states, coalescing their changes
+
+    states maps poolmember names to the state asked for. The caller
+    holding the locks calls write(changes) with the desired state of
+    every poolmember it has to bring up to date; write returns a
+    (result, error) per poolmember, a result of "ok" or "unchanged" when
+    the poolmember now has its desired state. Returns a (result, state,
+    error) per poolmember, "coalesced" with the state applied when
+    another caller brought it up to date.
+    """
+    r = get_redis(write=True)
+    keys = {name: '%s::%s::%s' % (device, pool, name) for name in states}
+    names = sorted(states)
+    window = get_config('lbproxyd', 'coalesce_window', 0.1, cast=float)
+    timeout = get_config('lbproxyd', 'coalesce_timeout', 30, cast=float)
+    ttl = int(timeout) + 60
+    token = uuid.uuid4().hex
+
+    pipe = r.pipeline()
+    for name in names:
+        pipe.hset(desired_prefix + keys[name], 'state',
+                  1 if states[name] else 0)
+        pipe.hincrby(desired_prefix + keys[name], 'generation', 1)
+        pipe.expire(desired_prefix + keys[name], ttl)
+    pipe.hincrby(stats_key, 'requested', len(names))
+    replies = pipe.execute()
+    generations = {name: replies[3 * i + 1] for i, name in enumerate(names)}
+
+    results = {}
+    held = []
+    try:
+        # Locks are taken in name order so that callers sharing several
+        # poolmembers cannot deadlock
+        deadline = time.time() + timeout
+        for name in names:
+            key = keys[name]
+            while not r.set(lock_prefix + key, token, nx=True,
+                            px=int(timeout * 1000)):
+                applied = _applied(r, key, generations[name])
+                if applied is not None:
+                    results[name] = ('coalesced', applied, None)
+                    break
+                if time.time() > deadline:
+                    raise WriteTimeout(
+                        "Timed out waiting to change {}/{}/{}".format(
+                            device, pool, name
+                        ))
+                time.sleep(0.05)
+            else:
+                held.append(name)
+
+        pending = []
+        for name in held:
+            applied = _applied(r, keys[name], generations[name])
+            if applied is None:
+                pending.append(name)
+            else:
+                results[name] = ('coalesced', applied, None)
+
+        # Only wait for more changes when some already arrived behind
+        # this one
+        current = _desired(r, keys, pending)
+        if any(current[name] and current[name][0] > generations[name]
+               for name in pending):
+            time.sleep(window)
+            current = _desired(r, keys, pending)
+        if pending:
+            _use_primary()
+
+        wrote = set()
+        while pending:
+            for name in pending:
+                if current[name] is None:
+                    current[name] = (generations[name], states[name])
+            outcome = write({name: current[name][1] for name in pending})
+
+            pipe = r.pipeline()
+            done = []
+            for name in pending:
+                result, error = outcome[name]
+                if result not in ('ok', 'unchanged'):
+                    results[name] = (result, None, error)
+                    continue
+                if result == 'ok':
+                    wrote.add(name)
+                    pipe.hincrby(stats_key, 'written', 1)
+                generation, state = current[name]
+                pipe.hmset(applied_prefix + keys[name], {
+                    'generation': generation, 'state': 1 if state else 0
+                })
+                pipe.expire(applied_prefix + keys[name], ttl)
+                results[name] = (
+                    'ok' if name in wrote else 'unchanged', state, None)
+                done.append(name)
+            pipe.execute()
+
+            # Write again the poolmembers changed meanwhile
+            latest = _desired(r, keys, done)
+            pending = [name for name in done if latest[name] and
+                       latest[name][0] > current[name][0]]
+            current = latest
+    finally:
+        for name in held:
+            if r.get(lock_prefix + keys[name]) == token:
+                r.delete(lock_prefix + keys[name])
+
+    for name in names:
+        if results[name][0] == 'coalesced':
+            logger.debug('Change of {} coalesced'.format(keys[name]))
+    return results
+
+
+def submit(device, pool, poolmember, state, skip_f5=False, slot=_no_slot):
+    """Bring a poolmember to state, coalescing with concurrent changes
+
+    Returns the state the poolmember ends up in, a later change of the
+    same poolmember may have replaced this one, and whether this call
+    wrote to the F5. slot is entered around every F5 write of the caller
+    holding the lock, for admission control.
+    """
+    def write(changes):
+        session.expire_all()
+        pm = Poolmember(poolmember, pool=pool, device=device)
+        pm.skip_f5 = skip_f5
+        if pm.enabled == changes[poolmember]:
+            return {poolmember: ('unchanged', None)}
+        with slot():
+            pm.enabled = changes[poolmember]
+        return {poolmember: ('ok', None)}
+
+    result, state, error = submit_many(
+        device, pool, {poolmember: state}, write)[poolmember]
+    return state, result == 'ok'
+
+
+def stats():
+    """Count the changes requested, written to the F5 and saved"""
+    counts = get_redis(write=False).hgetall(stats_key)
+    requested = int(counts.get('requested', 0))
+    written = int(counts.get('written', 0))
+    return {'requested': requested, 'written': written,
+            'saved': requested - written}
@@ -1,8 +1,13 @@
+import collections
+import os
 import socket
+import threading
+import time
+from contextlib import contextmanager
 
 import f5
 
-from .utils import config, get_logger
+from .utils import config, get_config, get_logger
 from .exceptions import F5ConnectionError, F5HostNotFound
 
 
@@ -12,15 +17,10 @@ logger = get_logger()
 f5_admin = config.get('f5', 'username')
 f5_admin_pass = config.get('f5', 'password')
 
-# A function that connects to the given F5 or reuses old connections
-f5_list = {}
 
-
-def open_connection(loadbalancer):
+def open_connection(loadbalancer, username=f5_admin, password=f5_admin_pass):
     try:
-        f5_list.update(
-            {loadbalancer: f5.Lb(loadbalancer, f5_admin, f5_admin_pass)}
-        )
+        return f5.Lb(loadbalancer, username, password)
     except socket.gaierror:
         raise F5HostNotFound(
             "Could not resolve {}. Please try again.".format(loadbalancer)
@@ -33,13 +33,198 @@ def open_connection(loadbalancer):
         )
 
 
-def connect_to_f5(loadbalancer):
-    if loadbalancer in f5_list:
+class F5Pool(object):
+    """A bounded pool of sessions to one loadbalancer
+
+    Sessions are opened on demand, up to max_size. Idle sessions are
+    health checked before being handed out again only when they sat
+    unused for longer than idle_check seconds, and evicted after
+    idle_timeout seconds while more than min_size are open. Failed
+    connection attempts back off exponentially up to max_backoff seconds.
+    """
+
+    def __init__(self, loadbalancer, username, password, min_size=1,
+                 max_size=4, timeout=30, idle_check=30, idle_timeout=300,
+                 backoff=1, max_backoff=60):
+        self.loadbalancer = loadbalancer
+        self.username = username
+        self.password = password
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self.idle_timeout = idle_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._idle = collections.deque()
+        self._size = 0
+        self._failures = 0
+        self._retry_at = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'created': 0,
+            'failed': 0, 'health_checks': 0, 'evicted': 0, 'in_use': 0,
+        }
+
+    def _evict_idle(self):
+        now = time.time()
+        while len(self._idle) and self._size > self.min_size:
+            lb, last_used = self._idle[0]
+            if now - last_used < self.idle_timeout:
+                break
+            self._idle.popleft()
+            self._size -= 1
+            self.stats['evicted'] += 1
+
+    def _connect(self):
+        if time.time() < self._retry_at:
+            raise F5ConnectionError(
+                "Could not connect to {}, retrying in {:.0f} seconds".format(
+                    self.loadbalancer, self._retry_at - time.time()
+                )
+            )
+        try:
+            lb = open_connection(
+                self.loadbalancer, self.username, self.password
+            )
+        except Exception:
+            with self._cond:
+                self._failures += 1
+                self._retry_at = time.time() + min(
+                    self.backoff * 2 ** (self._failures - 1), self.max_backoff
+                )
+                self.stats['failed'] += 1
+            raise
+        with self._cond:
+            self._failures = 0
+            self._retry_at = 0
+            self.stats['created'] += 1
+        return lb
+
+    def _healthy(self, lb):
+        with self._cond:
+            self.stats['health_checks'] += 1
+        try:
+            lb.failover_state
+            return True
+        except Exception as err:
+            logger.info('Discarding stale connection to {}: {}'.format(
+                self.loadbalancer, repr(err)
+            ))
+            return False
+
+    def checkout(self):
+        started = time.time()
+        deadline = started + self.timeout
+        lb = None
+        with self._cond:
+            while True:
+                self._evict_idle()
+                if len(self._idle):
+                    lb, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    last_used = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise F5ConnectionError(
+                        "Timed out waiting for a connection to {}".format(
+                            self.loadbalancer
+                        )
+                    )
+                self.stats['waits'] += 1
+                self._cond.wait(remaining)
+            self.stats['checkouts'] += 1
+            self.stats['wait_time'] += time.time() - started
+            self.stats['in_use'] += 1
+
         try:
-            f5_list[loadbalancer].failover_state
-        except:
-            open_connection(loadbalancer)
-        return f5_list[loadbalancer]
-    else:
-        open_connection(loadbalancer)
-        return f5_list[loadbalancer]
+            if lb is not None and time.time() - last_used > self.idle_check:
+                if not self._healthy(lb):
+                    lb = None
+            if lb is None:
+                lb = self._connect()
+        except Exception:
+            self._release(None)
+            raise
+        return lb
+
+    def checkin(self, lb, discard=False):
+        self._release(None if discard else lb)
+
+    def _release(self, lb):
+        with self._cond:
+            self.stats['in_use'] -= 1
+            if lb is None:
+                self._size -= 1
+            else:
+                self._idle.append((lb, time.time()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        lb = self.checkout()
+        try:
+            yield lb
+        except (OSError, socket.error):
+            self.checkin(lb, discard=True)
+            raise
+        except Exception:
+            self.checkin(lb)
+            raise
+        else:
+            self.checkin(lb)
+
+
+# One pool per loadbalancer and user, recreated in forked children
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(loadbalancer, username=f5_admin, password=f5_admin_pass,
+             **kwargs):
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        key = (loadbalancer, username)
+        if key not in _pools:
+            options = {
+                'min_size': get_config('f5', 'pool_min_size', 1, cast=int),
+                'max_size': get_config('f5', 'pool_max_size', 4, cast=int),
+                'timeout': get_config('f5', 'pool_timeout', 30, cast=float),
+                'idle_check': get_config(
+                    'f5', 'pool_idle_check', 30, cast=float),
+                'idle_timeout': get_config(
+                    'f5', 'pool_idle_timeout', 300, cast=float),
+                'backoff': get_config('f5', 'pool_backoff', 1, cast=float),
+                'max_backoff': get_config(
+                    'f5', 'pool_max_backoff', 60, cast=float),
+            }
+            options.update(kwargs)
+            _pools[key] = F5Pool(loadbalancer, username, password, **options)
+        return _pools[key]
+
+
+def f5_connection(loadbalancer, username=f5_admin, password=f5_admin_pass,
+                  **kwargs):
+    """Check out a pooled session, use it as a context manager"""
+    return get_pool(loadbalancer, username, password, **kwargs).connection()
+
+
+def pool_stats():
+    """Session pool counters of this process, summed per loadbalancer"""
+    with _pools_lock:
+        pools = list(_pools.values()) if _pools_pid == os.getpid() else []
+    stats = {}
+    for pool in pools:
+        totals = stats.setdefault(pool.loadbalancer, {})
+        for name, value in dict(pool.stats, size=pool._size,
+                                idle=len(pool._idle)).items():
+            totals[name] = totals.get(name, 0) + value
+    return stats
@@ -1,8 +1,33 @@
-from sqlalchemy.orm import sessionmaker
+import random
+
+from sqlalchemy import inspect, select, MetaData, Table
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
+from sqlalchemy.sql.expression import UpdateBase
 from lbproxy.db import models
 
 _engine = models.engine
+_replicas = models.replicas
 _maker = None
+_scoped = None
+
+
+class RoutingSession(Session):
+    """Send reads to a replica and everything else to the primary
+
+    Flushes, insert/update/delete statements and whatever runs inside an
+    explicit transaction go to the primary. Once the session wrote or
+    info['force_primary'] is set, its reads stay on the primary too so
+    they see its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not _replicas or self.info.get('force_primary'):
+            return _engine
+        if self._flushing or self.transaction is not None or \
+                isinstance(clause, UpdateBase):
+            self.info['force_primary'] = True
+            return _engine
+        return random.choice(_replicas)
 
 
 def get_database_session(autocommit=True, expire_on_commit=False):
@@ -10,12 +35,98 @@ def get_database_session(autocommit=True, expire_on_commit=False):
     if not _maker:
         assert _engine
         _maker = sessionmaker(bind=_engine,
+                              class_=RoutingSession,
                               autocommit=autocommit,
                               expire_on_commit=expire_on_commit)
     return _maker()
 
 
+def get_scoped_session():
+    """Return a registry giving every thread its own database session
+
+    Call remove() on it at the end of each unit of work, a request or a
+    collection, to close the session and hand its connection back.
+    """
+    global _scoped
+    if not _scoped:
+        _scoped = scoped_session(get_database_session)
+    return _scoped
+
+
 def unregister_database_models(base):
     global _engine
     assert _engine
     base.metadata.drop_all(_engine)
+
+
+def migrate_legacy_schema(drop=True):
+    """Copy the poolmembers of the single table schema to the current one
+
+    The legacy poolmembers and poolmember_properties tables are dropped
+    afterwards unless drop is False. Returns the number of poolmembers
+    copied, nothing is copied when the current tables already have data.
+    """
+    global _engine
+    assert _engine
+    if 'poolmembers' not in inspect(_engine).get_table_names():
+        return 0
+
+    session = get_database_session()
+    session.info['force_primary'] = True
+    if session.query(models.PoolMember.id).first():
+        raise Exception('The pool_members table is not empty, '
+                        'refusing to migrate over existing data')
+
+    metadata = MetaData()
+    legacy = Table('poolmembers', metadata,
+                   autoload=True, autoload_with=_engine)
+    legacy_properties = Table('poolmember_properties', metadata,
+                              autoload=True, autoload_with=_engine)
+    rows = _engine.execute(select([
+        legacy.c.id, legacy.c.device, legacy.c.partition, legacy.c.pool,
+        legacy.c.nodename, legacy_properties.c.port, legacy_properties.c.status
+    ]).select_from(legacy.outerjoin(
+        legacy_properties, legacy_properties.c.poolmember_id == legacy.c.id
+    ))).fetchall()
+
+    devices = models.intern_names(
+        session, models.Device, [row[1] for row in rows])
+    partitions = models.intern_names(
+        session, models.Partition, [row[2] for row in rows])
+    pools = models.intern_names(
+        session, models.Pool, [row[3] for row in rows])
+    nodes = models.intern_names(
+        session, models.Node, [row[4] for row in rows])
+    poolmembers = {row[0]: (devices[row[1]], partitions[row[2]],
+                            pools[row[3]], nodes[row[4]]) for row in rows}
+
+    session.begin()
+    try:
+        if poolmembers:
+            session.execute(models.PoolMember.__table__.insert(), [
+                {'device_id': ids[0], 'partition_id': ids[1],
+                 'pool_id': ids[2], 'node_id': ids[3]}
+                for ids in poolmembers.values()
+            ])
+        new_ids = {(row[1], row[2], row[3], row[4]): row[0]
+                   for row in session.query(
+            models.PoolMember.id, models.PoolMember.device_id,
+            models.PoolMember.partition_id, models.PoolMember.pool_id,
+            models.PoolMember.node_id).all()}
+        properties = [
+            {'poolmember_id': new_ids[poolmembers[row[0]]],
+             'port': row[5], 'status': row[6]}
+            for row in rows if row[5] is not None
+        ]
+        if properties:
+            session.execute(
+                models.PoolMemberProperty.__table__.insert(), properties)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    if drop:
+        legacy_properties.drop(_engine)
+        legacy.drop(_engine)
+    return len(poolmembers)
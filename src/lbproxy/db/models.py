@@ -1,60 +1,118 @@
 import datetime
+import os
 
 from sqlalchemy import (
     create_engine, event,
     Boolean, Column, Date, Integer, String,
-    ForeignKey, UniqueConstraint
+    ForeignKey, Index, UniqueConstraint
 )
+from sqlalchemy.exc import DisconnectionError, IntegrityError
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.pool import NullPool
 
-from lbproxy.utils import config
+from lbproxy.utils import config, get_config
 
 Base = declarative_base()
 
 
+class Device(Base):
+    __tablename__ = 'devices'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        return "<Device('%s')>" % self.name
+
+
+class Partition(Base):
+    __tablename__ = 'partitions'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        return "<Partition('%s')>" % self.name
+
+
+class Pool(Base):
+    __tablename__ = 'pools'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        return "<Pool('%s')>" % self.name
+
+
+class Node(Base):
+    __tablename__ = 'nodes'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        return "<Node('%s')>" % self.name
+
+
 class PoolMember(Base):
-    __tablename__ = 'poolmembers'
-    __table_args__ = (UniqueConstraint(
-        'device', 'partition', 'pool',
-        'nodename', name='_pm_mapping'),
-                      {'mysql_engine': 'InnoDB'}
+    __tablename__ = 'pool_members'
+    __table_args__ = (
+        UniqueConstraint('device_id', 'partition_id', 'pool_id', 'node_id',
+                         name='_pm_mapping'),
+        # One index per lookup pattern of the lbproxy domain classes
+        Index('ix_pm_device_pool', 'device_id', 'pool_id', 'node_id'),
+        Index('ix_pm_node', 'node_id', 'device_id', 'pool_id'),
+        Index('ix_pm_partition', 'partition_id', 'pool_id', 'node_id'),
+        Index('ix_pm_pool', 'pool_id', 'device_id', 'node_id'),
+        {'mysql_engine': 'InnoDB'}
     )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    device = Column(String(100), nullable=False)
-    partition = Column(String(100), nullable=False)
-    pool = Column(String(100), nullable=False)
-    nodename = Column(String(100), nullable=False)
+    device_id = Column(Integer, ForeignKey('devices.id'), nullable=False)
+    partition_id = Column(Integer, ForeignKey('partitions.id'),
+                          nullable=False)
+    pool_id = Column(Integer, ForeignKey('pools.id'), nullable=False)
+    node_id = Column(Integer, ForeignKey('nodes.id'), nullable=False)
     created_at = Column(Date, default=datetime.datetime.now)
     updated_at = Column(Date, onupdate=datetime.datetime.now)
+    device = relationship('Device')
+    partition = relationship('Partition')
+    pool = relationship('Pool')
+    node = relationship('Node')
+    # Loaded in the same query as the poolmember, status reads are one
+    # round-trip
     poolmemberproperty = relationship(
-        'PoolMemberProperty', cascade='all,delete', backref='poolmembers'
+        'PoolMemberProperty', cascade='all,delete', backref='poolmember',
+        lazy='joined'
     )
 
-    def __init__(self, device, partition, pool, nodename):
-        self.device = device
-        self.partition = partition
-        self.pool = pool
-        self.nodename = nodename
+    def __init__(self, device_id, partition_id, pool_id, node_id):
+        self.device_id = device_id
+        self.partition_id = partition_id
+        self.pool_id = pool_id
+        self.node_id = node_id
 
     def __repr__(self):
         return "<Poolmember('%s','%s','%s','%s')>" % (
-            self.device, self.partition,
-            self.pool, self.nodename
+            self.device.name, self.partition.name,
+            self.pool.name, self.node.name
         )
 
 
 class PoolMemberProperty(Base):
-    __tablename__ = 'poolmember_properties'
+    __tablename__ = 'pool_member_properties'
     __table_args__ = (UniqueConstraint(
         'poolmember_id', 'port', name='_pmid_mapping'),
                       {'mysql_engine': 'InnoDB'}
     )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    poolmember_id = Column(Integer, ForeignKey('poolmembers.id'),
+    poolmember_id = Column(Integer, ForeignKey('pool_members.id'),
                            nullable=False)
     port = Column(Integer, nullable=False)
     status = Column(Boolean, nullable=False)
@@ -68,29 +126,135 @@ class PoolMemberProperty(Base):
 
     def __repr__(self):
         return "<PoolMemberProperty('%s','%s','%s')>" % (
-            self.poolmember.nodename, self.port, self.status
+            self.poolmember.node.name, self.port, self.status
+        )
+
+
+# Names of the dimensions poolmembers are looked up by
+dimensions = {
+    'device': (Device, PoolMember.device_id),
+    'partition': (Partition, PoolMember.partition_id),
+    'pool': (Pool, PoolMember.pool_id),
+    'nodename': (Node, PoolMember.node_id),
+}
+
+
+def query_poolmembers(session, *fields, **filters):
+    """Query poolmembers selecting and filtering by dimension names
+
+    fields are dimension names ('device', 'partition', 'pool' or
+    'nodename') or mapped entities and columns, filters map dimension
+    names to the value they must have. Every dimension used is joined
+    once on its integer key.
+    """
+    joined = []
+    columns = []
+    for field in fields:
+        if field in dimensions:
+            columns.append(dimensions[field][0].name)
+            joined.append(field)
+        else:
+            columns.append(field)
+    joined.extend(name for name in filters if name not in joined)
+
+    query = session.query(*columns).select_from(PoolMember)
+    for name in joined:
+        model, key = dimensions[name]
+        query = query.join(model, key == model.id)
+    for name, value in filters.items():
+        query = query.filter(dimensions[name][0].name == value)
+    return query
+
+
+def intern_names(session, model, names):
+    """Return {name: id} of a dimension table, inserting missing names
+
+    Must be called outside of a transaction, missing names are committed
+    right away so concurrent collectors do not conflict for long.
+    """
+    names = sorted(set(names))
+    ids = {}
+    for i in range(0, len(names), 500):
+        ids.update(session.query(model.name, model.id).filter(
+            model.name.in_(names[i:i + 500])).all())
+    missing = [name for name in names if name not in ids]
+    if not missing:
+        return ids
+
+    try:
+        session.execute(model.__table__.insert(),
+                        [{'name': name} for name in missing])
+    except IntegrityError:
+        # Another process interned some of them first
+        for name in missing:
+            try:
+                session.execute(model.__table__.insert(), {'name': name})
+            except IntegrityError:
+                pass
+    for i in range(0, len(missing), 500):
+        ids.update(session.query(model.name, model.id).filter(
+            model.name.in_(missing[i:i + 500])).all())
+    return ids
+
+
+def _fk_pragma_on_connect(dbapi_con, con_record):
+    dbapi_con.execute('pragma foreign_keys=ON')
+
+
+# Connections opened before a fork belong to the parent, children of
+# lbproxyd in prefork mode and of the scheduler open their own
+def _record_pid(dbapi_con, con_record):
+    con_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_con, con_record, con_proxy):
+    if con_record.info['pid'] != os.getpid():
+        con_record.connection = con_proxy.connection = None
+        raise DisconnectionError(
+            'Connection record belongs to pid %s, attempting to check '
+            'out in pid %s' % (con_record.info['pid'], os.getpid())
         )
 
 
+def _create_engine(url):
+    if url.startswith('sqlite'):
+        _engine = create_engine(url)
+        event.listen(_engine, 'connect', _fk_pragma_on_connect)
+        return _engine
+
+    _engine = create_engine(
+        url,
+        pool_size=get_config('lbproxyd', 'pool_size', 10, cast=int),
+        max_overflow=get_config('lbproxyd', 'max_overflow', 10, cast=int),
+        pool_recycle=get_config('lbproxyd', 'pool_recycle', 3600, cast=int),
+        pool_pre_ping=config.getboolean('lbproxyd', 'pool_pre_ping',
+                                        fallback=True)
+    )
+    event.listen(_engine, 'connect', _record_pid)
+    event.listen(_engine, 'checkout', _check_pid)
+    return _engine
+
+
 database_type = config.get('lbproxyd', 'database_type')
 database_name = config.get('lbproxyd', 'database_name')
 
 engine = None
 if 'sqlite' in database_type:
-    def _fk_pragma_on_connect(dbapi_con, con_record):
-        dbapi_con.execute('pragma foreign_keys=ON')
-
-    engine = create_engine('%s:///%s' % (database_type, database_name))
-    event.listen(engine, 'connect', _fk_pragma_on_connect)
+    engine = _create_engine('%s:///%s' % (database_type, database_name))
 else:
     database_user = config.get('lbproxyd', 'database_user')
     database_pass = config.get('lbproxyd', 'database_pass')
     database_host = config.get('lbproxyd', 'database_host')
-    engine = create_engine("%s://%s:%s@%s/%s" % (database_type,
-                                                 database_user,
-                                                 database_pass,
-                                                 database_host,
-                                                 database_name),
-                           poolclass=NullPool)
+    engine = _create_engine("%s://%s:%s@%s/%s" % (database_type,
+                                                  database_user,
+                                                  database_pass,
+                                                  database_host,
+                                                  database_name))
+
+# Read only copies of the database, queries outside of writes go to them
+replicas = [
+    _create_engine(url.strip()) for url in get_config(
+        'lbproxyd', 'database_replicas', '').split(',') if url.strip()
+]
 
 Base.metadata.create_all(engine)
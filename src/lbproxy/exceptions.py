@@ -42,3 +42,7 @@ class F5HostNotFound(Exception):
 
 class F5ConnectionError(Exception):
     pass
+
+
+class WriteTimeout(Exception):
+    pass
@@ -0,0 +1,254 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""A redis backed queue of F5 write jobs
+
+lbproxyd enqueues mutations when async_writes is set and answers right
+away with the id of the job; lbproxy-worker processes run them. Every
+job is a redis hash holding its kind, payload, status and result, kept
+for job_ttl seconds. A device never has more than device_concurrency
+jobs running at the same time, jobs over the limit go back to the queue.
+
+Workers move the jobs they take to a processing list and keep renewing
+their claim while running them; recover() puts back in the queue the
+jobs whose claim lapsed because their worker died.
+"""
+
+import json
+import threading
+import time
+import uuid
+
+from .exceptions import PoolMemberDoesNotExist
+from .utils import (
+    get_config, get_logger, get_redis, release_slot, renew_slot, take_slot
+)
+from . import Poolmember, batch, coalesce, session
+
+logger = get_logger()
+
+queue_key = 'beam::lbproxy::jobs::queue'
+processing_key = 'beam::lbproxy::jobs::processing'
+job_prefix = 'beam::lbproxy::job::'
+running_prefix = 'beam::lbproxy::jobs::running::'
+
+
+def _poolmember(payload):
+    pm = Poolmember(name=payload['poolmember'], pool=payload['pool'],
+                    device=payload['device'])
+    if not pm.exists():
+        raise PoolMemberDoesNotExist(
+            "Poolmember not found: {}/{}/{}".format(
+                payload['device'], payload['pool'], payload['poolmember']
+            ))
+    state, wrote = coalesce.submit(
+        payload['device'], payload['pool'], payload['poolmember'],
+        payload['state']
+    )
+    return {"status": "enabled" if state else "disabled"}
+
+
+def _batch(payload):
+    return {"results": batch.apply(payload['changes'])}
+
+
+# Functions running each kind of job, they return the job result
+handlers = {
+    'poolmember': _poolmember,
+    'batch': _batch,
+}
+
+
+def enqueue(kind, payload, devices=()):
+    """Queue a job of a known kind, return its id
+
+    devices are the loadbalancers the job writes to, they bound how many
+    jobs run at the same time.
+    """
+    if kind not in handlers:
+        raise ValueError('Unknown job kind {}'.format(kind))
+    job_id = uuid.uuid4().hex
+    key = job_prefix + job_id
+    pipe = get_redis(write=True).pipeline()
+    pipe.hmset(key, {
+        'id': job_id,
+        'kind': kind,
+        'payload': json.dumps(payload),
+        'devices': json.dumps(sorted(set(devices))),
+        'status': 'queued',
+        'created': time.time(),
+    })
+    pipe.expire(key, get_config('lbproxy-worker', 'job_ttl', 86400, cast=int))
+    pipe.lpush(queue_key, job_id)
+    pipe.execute()
+    logger.debug('Queued {} job {}'.format(kind, job_id))
+    return job_id
+
+
+def get_job(job_id):
+    """Return the status of a job, None if it is unknown or expired"""
+    job = get_redis(write=False).hgetall(job_prefix + job_id)
+    if not job:
+        return None
+    for field in ('payload', 'devices', 'result'):
+        if field in job:
+            job[field] = json.loads(job[field])
+    for field in ('created', 'claimed', 'started', 'finished'):
+        if field in job:
+            job[field] = float(job[field])
+    if 'attempts' in job:
+        job['attempts'] = int(job['attempts'])
+    return job
+
+
+def _acquire(devices):
+    """Take a running slot on every device or none of them
+
+    Returns the tokens of the slots by device, None when one is busy.
+    """
+    limit = get_config('lbproxy-worker', 'device_concurrency', 2, cast=int)
+    timeout = get_config('lbproxy-worker', 'job_timeout', 600, cast=int)
+    tokens = {}
+    for device in devices:
+        token = take_slot(running_prefix + device, limit, timeout)
+        if token is None:
+            _release(tokens)
+            return None
+        tokens[device] = token
+    return tokens
+
+
+def _release(tokens):
+    for device, token in tokens.items():
+        release_slot(running_prefix + device, token)
+
+
+def _heartbeat(r, key, tokens, stopped):
+    """Renew the claim of a running job and its slots until it stops"""
+    timeout = get_config('lbproxy-worker', 'job_timeout', 600, cast=int)
+    while not stopped.wait(timeout / 3.0):
+        try:
+            r.hset(key, 'claimed', time.time())
+            for device, token in tokens.items():
+                renew_slot(running_prefix + device, token, timeout)
+        except Exception as e:
+            logger.error('Renewing the claim of {} failed: {}'.format(
+                key, e
+            ))
+
+
+def run(job_id):
+    """Run one claimed job, False when its devices are busy"""
+    r = get_redis(write=True)
+    key = job_prefix + job_id
+    job = r.hgetall(key)
+    if not job:
+        logger.info('Job {} expired before running'.format(job_id))
+        return True
+    tokens = _acquire(json.loads(job['devices']))
+    if tokens is None:
+        return False
+
+    r.hmset(key, {'status': 'running', 'claimed': time.time(),
+                  'started': time.time()})
+    r.hincrby(key, 'attempts', 1)
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat,
+                                 args=(r, key, tokens, stopped))
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+        result = handlers[job['kind']](json.loads(job['payload']))
+    except Exception as err:
+        logger.error('Job {} failed: {}'.format(job_id, repr(err)))
+        r.hmset(key, {'status': 'failed', 'error': repr(err),
+                      'finished': time.time()})
+    else:
+        r.hmset(key, {'status': 'done', 'result': json.dumps(result),
+                      'finished': time.time()})
+    finally:
+        stopped.set()
+        session.remove()
+        _release(tokens)
+    return True
+
+
+def recover():
+    """Queue again the jobs whose worker died while holding them
+
+    A job is given up as failed once it was started job_attempts times.
+    """
+    r = get_redis(write=True)
+    timeout = get_config('lbproxy-worker', 'job_timeout', 600, cast=int)
+    attempts = get_config('lbproxy-worker', 'job_attempts', 3, cast=int)
+    now = time.time()
+    for job_id in r.lrange(processing_key, 0, -1):
+        key = job_prefix + job_id
+        job = r.hgetall(key)
+        if not job:
+            r.lrem(processing_key, 1, job_id)
+            continue
+        if 'claimed' not in job:
+            # Just taken, or taken by a worker dying before claiming it
+            r.hsetnx(key, 'claimed', now)
+            continue
+        if float(job['claimed']) + timeout > now:
+            continue
+        # Only the process removing it from the list requeues it
+        if not r.lrem(processing_key, 1, job_id):
+            continue
+        if int(job.get('attempts', 0)) >= attempts:
+            logger.error('Job {} failed, its worker died {} times'.format(
+                job_id, attempts
+            ))
+            r.hmset(key, {'status': 'failed', 'finished': now,
+                          'error': 'The worker running the job died'})
+        else:
+            logger.info('Queueing again job {} of a dead worker'.format(
+                job_id
+            ))
+            pipe = r.pipeline()
+            pipe.hset(key, 'status', 'queued')
+            pipe.hdel(key, 'claimed')
+            pipe.rpush(queue_key, job_id)
+            pipe.execute()
+
+
+def work(stopping):
+    """Run jobs until stopping() is true"""
+    while not stopping():
+        r = get_redis(write=True)
+        try:
+            job_id = r.brpoplpush(queue_key, processing_key, timeout=1)
+        except Exception as e:
+            logger.error('Reading the job queue failed: %s' % e)
+            time.sleep(1)
+            continue
+        if job_id is None:
+            continue
+        try:
+            done = run(job_id)
+        except Exception as e:
+            # Left in the processing list, recover() queues it again
+            logger.error('Running job {} failed: {}'.format(job_id, e))
+            time.sleep(1)
+            continue
+        pipe = r.pipeline()
+        pipe.lrem(processing_key, 1, job_id)
+        if not done:
+            # Back to the end of the queue until its devices free up,
+            # unclaimed
+            pipe.hdel(job_prefix + job_id, 'claimed')
+            pipe.lpush(queue_key, job_id)
+        pipe.execute()
+        if not done:
+            time.sleep(0.1)
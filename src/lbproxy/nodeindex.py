@@ -0,0 +1,120 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Reverse index from nodes to the poolmembers they back
+
+Every node has a redis hash mapping "<device>|<pool>" to "<port>|<status>"
+of its poolmembers, and every device a set of the nodes indexed on it so
+a full sweep of the collector can drop entries that went stale. The
+collector and the write paths of lbproxy keep it up to date. Devices are
+only trusted once a full sweep built their entries, until then, after
+redis lost them or an update failed, their nodes are read from the
+database.
+"""
+
+from .utils import get_logger, get_redis
+
+logger = get_logger()
+
+node_prefix = 'beam::lbproxy::node::'
+device_prefix = 'beam::lbproxy::node_index::'
+# set of the devices whose entries are complete
+built_key = 'beam::lbproxy::node_index_built'
+
+
+def _field(device, pool):
+    return '%s|%s' % (device, pool)
+
+
+def _value(port, enabled):
+    return '%s|%d' % (port, 1 if enabled else 0)
+
+
+def update(device, added=(), removed=()):
+    """Index (pool, node, port, enabled) members and drop (pool, node) ones"""
+    try:
+        pipe = get_redis(write=True).pipeline(transaction=True)
+        for pool, node, port, enabled in added:
+            pipe.hset(node_prefix + node, _field(device, pool),
+                      _value(port, enabled))
+            pipe.sadd(device_prefix + device, node)
+        for member in removed:
+            pipe.hdel(node_prefix + member[1], _field(device, member[0]))
+        pipe.execute()
+    except Exception as e:
+        logger.error('Updating the node index of {} failed: {}'.format(
+            device, e
+        ))
+        # Its entries are incomplete until the next full sweep
+        try:
+            get_redis(write=True).srem(built_key, device)
+        except Exception as e:
+            logger.error('Could not mark the node index of {} as '
+                         'incomplete: {}'.format(device, e))
+
+
+def rebuild(device, members):
+    """Replace the entries of a device with (pool, node, port, enabled)"""
+    r = get_redis(write=True)
+    nodes = {}
+    for pool, node, port, enabled in members:
+        nodes.setdefault(node, {})[_field(device, pool)] = _value(
+            port, enabled)
+
+    previous = list(r.smembers(device_prefix + device))
+    pipe = r.pipeline(transaction=False)
+    for node in previous:
+        pipe.hkeys(node_prefix + node)
+    prefix = device + '|'
+    stale = {node: [field for field in fields if field.startswith(prefix)
+                    and field not in nodes.get(node, {})]
+             for node, fields in zip(previous, pipe.execute())}
+
+    pipe = r.pipeline(transaction=True)
+    for node, fields in stale.items():
+        if fields:
+            pipe.hdel(node_prefix + node, *fields)
+    for node, fields in nodes.items():
+        pipe.hmset(node_prefix + node, fields)
+    pipe.delete(device_prefix + device)
+    if nodes:
+        pipe.sadd(device_prefix + device, *nodes)
+    pipe.sadd(built_key, device)
+    pipe.execute()
+
+
+def built():
+    """Devices whose entries are complete"""
+    return get_redis(write=False).smembers(built_key)
+
+
+def lookup(nodes):
+    """Locate many nodes in one round-trip
+
+    Returns {node: [(device, partition, pool, port, enabled), ...]}.
+    """
+    nodes = list(nodes)
+    pipe = get_redis(write=False).pipeline(transaction=False)
+    for node in nodes:
+        pipe.hgetall(node_prefix + node)
+
+    located = {}
+    for node, entries in zip(nodes, pipe.execute()):
+        located[node] = []
+        for field, value in entries.items():
+            device, pool = field.split('|', 1)
+            port, enabled = value.split('|')
+            located[node].append((
+                device, '/{}'.format(pool.split('/')[1]), pool, int(port),
+                enabled == '1'
+            ))
+    return located
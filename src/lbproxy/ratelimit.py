@@ -0,0 +1,156 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Per client rate limits and admission control of F5 writes
+
+Every client, the X-Beam-User of its requests or else its address, has a
+token bucket in redis for each class of request: member reads, device
+and partition dumps and writes. Buckets refill at <class>_rate tokens per
+second up to <class>_burst; a request finding its bucket empty is
+answered 429 with the seconds until the next token in Retry-After.
+Requests writing to the F5s also take one of f5_concurrency slots shared
+by every lbproxyd worker, or are answered 503.
+"""
+
+import math
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from bottle import HTTPError, request
+
+from .utils import (
+    config, get_config, get_logger, get_redis, release_slot, take_slot
+)
+
+logger = get_logger()
+
+bucket_prefix = 'beam::lbproxy::ratelimit::'
+f5_key = 'beam::lbproxy::ratelimit::f5_slots'
+
+# Refill a bucket, take a token if there is one and return the seconds
+# to wait for one otherwise; numbers go through strings to keep decimals
+_take_script = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+# Default rate and burst of every class of request
+classes = {
+    'member': (50, 100),
+    'dump': (0.2, 2),
+    'write': (5, 20),
+}
+
+
+def is_enabled():
+    return config.getboolean('ratelimit', 'enabled', fallback=False)
+
+
+def client():
+    return request.headers.get('X-Beam-User') or request.remote_addr
+
+
+def take(name, kind):
+    """Take a token of a client, return 0 or the seconds to wait for one"""
+    rate, burst = classes[kind]
+    rate = get_config('ratelimit', kind + '_rate', rate, cast=float)
+    burst = get_config('ratelimit', kind + '_burst', burst, cast=float)
+    if rate <= 0:
+        return 0
+    r = get_redis(write=True)
+    script = r.register_script(_take_script)
+    return float(script(keys=['{}{}::{}'.format(bucket_prefix, kind, name)],
+                        args=[rate, burst, time.time()]))
+
+
+def rate_limit(kind):
+    """Answer 429 when the client of a request ran out of kind tokens"""
+    def decorator(f):
+        @wraps(f)
+        def limited(*args, **kwargs):
+            if is_enabled():
+                name = client()
+                try:
+                    wait = take(name, kind)
+                except Exception as e:
+                    logger.error('Rate limiting failed: %s' % e)
+                    wait = 0
+                if wait > 0:
+                    logger.info('Rate limited {} on {} requests'.format(
+                        name, kind
+                    ))
+                    raise HTTPError(429, 'Too many {} requests'.format(kind),
+                                    **{'Retry-After': str(math.ceil(wait))})
+            return f(*args, **kwargs)
+
+        return limited
+
+    return decorator
+
+
+@contextmanager
+def f5_slot(wanted=1):
+    """Hold f5_concurrency slots while writing to the F5s
+
+    Up to wanted slots are taken, one per F5 write running at the same
+    time; the block is given how many it got, at least one. Slots of
+    lbproxyd workers dying while holding them free up after f5_timeout
+    seconds.
+    """
+    if not is_enabled():
+        yield wanted
+        return
+    limit = get_config('ratelimit', 'f5_concurrency', 32, cast=int)
+    timeout = get_config('ratelimit', 'f5_timeout', 60, cast=int)
+    tokens = []
+    try:
+        while len(tokens) < wanted:
+            token = take_slot(f5_key, limit, timeout)
+            if token is None:
+                break
+            tokens.append(token)
+    except Exception as e:
+        logger.error('F5 admission control failed: %s' % e)
+        _release(tokens)
+        yield wanted
+        return
+    if not tokens:
+        logger.info('Too many F5 writes running, rejecting')
+        raise HTTPError(503, 'Too many loadbalancer writes running',
+                        **{'Retry-After': '1'})
+    try:
+        yield len(tokens)
+    finally:
+        _release(tokens)
+
+
+def _release(tokens):
+    for token in tokens:
+        try:
+            release_slot(f5_key, token)
+        except Exception as e:
+            logger.error('F5 admission control failed: %s' % e)
@@ -0,0 +1,349 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from .utils import config, config_file, get_logger, reload_auth
+
+logger = get_logger()
+
+
+class KeepAliveServerHandler(ServerHandler):
+    """Remember whether the response allows reusing the connection
+
+    Streamed HTTP/1.1 responses, which have no Content-Length, are sent
+    with chunked transfer encoding so the connection stays reusable.
+    """
+
+    keep_alive = False
+    chunked = False
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers and \
+                self.http_version == '1.1' and \
+                self.status[:3] not in ('204', '304'):
+            self.headers['Transfer-Encoding'] = 'chunked'
+            self.chunked = True
+
+    def write(self, data):
+        if not self.status:
+            raise AssertionError("write() before start_response()")
+        if not self.headers_sent:
+            # Decides whether the body is chunked
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+        if not self.chunked:
+            self._write(data)
+        elif data:
+            self._write(('%x\r\n' % len(data)).encode('ascii'))
+            self._write(data)
+            self._write(b'\r\n')
+        self._flush()
+
+    def finish_content(self):
+        if not self.headers_sent:
+            ServerHandler.finish_content(self)
+        elif self.chunked:
+            self._write(b'0\r\n\r\n')
+            self._flush()
+
+    def close(self):
+        headers = self.headers
+        self.keep_alive = headers is not None and \
+            ('Content-Length' in headers or self.chunked) and \
+            (headers.get('Connection') or '').lower() != 'close'
+        ServerHandler.close(self)
+
+
+class RequestBody(object):
+    """The body of one request, read at most up to its Content-Length"""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def _limit(self, size):
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+        return size
+
+    def read(self, size=-1):
+        data = self.rfile.read(self._limit(size)) if self.remaining else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.rfile.readline(self._limit(size)) \
+            if self.remaining else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit=65536):
+        """Discard what the application did not read, False if too much"""
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(self.remaining):
+                return False
+        return True
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """Serve several requests over one HTTP/1.1 connection"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, OSError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+
+        # Bodies are only delimited by Content-Length, anything else could
+        # leave bytes parsed as the next request of the connection
+        if self.headers.get('Transfer-Encoding'):
+            self.close_connection = True
+            self.send_error(411, 'Chunked request bodies are not supported')
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self.close_connection = True
+            self.send_error(400, 'Invalid Content-Length')
+            return
+        body = RequestBody(self.rfile, length)
+
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=True, multiprocess=self.server.multiprocess
+        )
+        handler.request_handler = self
+        if self.request_version == 'HTTP/1.1':
+            handler.http_version = '1.1'
+        handler.run(self.server.get_app())
+        if not handler.keep_alive or not body.drain():
+            self.close_connection = True
+
+
+class PooledWSGIServer(WSGIServer):
+    """A WSGI server running requests on a bounded pool of threads
+
+    Connections beyond the busy threads wait in a queue of max_queued
+    entries; when that is full they are answered with 503 right away.
+    """
+
+    multiprocess = False
+
+    def __init__(self, address, threads=16, max_queued=64, backlog=128,
+                 keepalive=5):
+        self.request_queue_size = backlog
+        KeepAliveHandler.timeout = keepalive
+        WSGIServer.__init__(self, address, KeepAliveHandler,
+                            bind_and_activate=False)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_bind()
+        self.server_activate()
+        self.threads = threads
+        self.max_queued = max_queued
+        self._executor = None
+        self._slots = None
+
+    def serve_forever(self, poll_interval=0.5):
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._slots = threading.BoundedSemaphore(
+            self.threads + self.max_queued
+        )
+        try:
+            WSGIServer.serve_forever(self, poll_interval)
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(False):
+            logger.warning('Request queue full, rejecting %s' % (
+                client_address[0]
+            ))
+            try:
+                request.sendall(b'HTTP/1.1 503 Service Unavailable\r\n'
+                                b'Content-Length: 0\r\n'
+                                b'Connection: close\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+
+def drop_privileges(uid, gid):
+    os.setgid(gid)
+    os.setuid(uid)
+
+
+class Prefork(object):
+    """Fork workers sharing one listening socket and keep them running
+
+    SIGHUP re-reads the configuration and replaces every worker, letting
+    the old ones finish their in-flight requests. SIGTERM and SIGINT stop
+    the workers gracefully and then the master.
+    """
+
+    def __init__(self, server, workers):
+        self.server = server
+        self.server.multiprocess = True
+        self.workers = workers
+        self.current = set()
+        self.retiring = set()
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.current.add(pid)
+            return
+        try:
+            self.work()
+        finally:
+            os._exit(0)
+
+    def work(self):
+        def stop(signum, frame):
+            threading.Thread(target=self.server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        logger.info('Worker %s started' % os.getpid())
+        self.server.serve_forever()
+        logger.info('Worker %s stopped' % os.getpid())
+
+    def kill(self, pids, sig=signal.SIGTERM):
+        for pid in list(pids):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def reload(self, signum, frame):
+        logger.info('Reloading lbproxyd workers')
+        config.read(config_file)
+        reload_auth()
+        self.retiring |= self.current
+        self.current = set()
+        self.kill(self.retiring)
+        for _ in range(self.workers):
+            self.spawn()
+
+    def stop(self, signum, frame):
+        logger.info('Stopping lbproxyd workers')
+        self.stopping = True
+        self.kill(self.current | self.retiring)
+
+    def run(self):
+        for _ in range(self.workers):
+            self.spawn()
+
+        signal.signal(signal.SIGHUP, self.reload)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while self.current or self.retiring:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            self.retiring.discard(pid)
+            if pid in self.current:
+                self.current.discard(pid)
+                if not self.stopping:
+                    logger.warning('Worker %s died, respawning' % pid)
+                    self.spawn()
+        self.server.server_close()
+
+
+def serve(app, host, port, uid, gid, mode='threaded', workers=4,
+          threads=16, max_queued=64, backlog=128, keepalive=5):
+    """Bind, drop privileges and serve app in threaded or prefork mode"""
+    server = PooledWSGIServer(
+        (host, port), threads=threads, max_queued=max_queued,
+        backlog=backlog, keepalive=keepalive
+    )
+    server.set_app(app)
+    drop_privileges(uid, gid)
+
+    if mode == 'prefork':
+        logger.info('Serving on {}:{} with {} workers of {} threads'.format(
+            host, port, workers, threads
+        ))
+        Prefork(server, workers).run()
+    else:
+        logger.info('Serving on {}:{} with {} threads'.format(
+            host, port, threads
+        ))
+
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown).start()
+
+        def reload(signum, frame):
+            logger.info('Reloading lbproxyd configuration')
+            config.read(config_file)
+            reload_auth()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, reload)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
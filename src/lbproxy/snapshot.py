@@ -0,0 +1,378 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""In memory snapshots of the poolmembers of every device
+
+A snapshot of a device is built from the database and published to
+redis as a versioned, compressed blob; the changes made after it are
+published as small deltas next to it, so a write never reads the whole
+device again. lbproxyd workers load every published device once and then
+poll the versions, applying the deltas of the devices that changed or
+loading their blob again when a newer one was published; a read also
+checks the version of its device so it never answers from an outdated
+one. Reads served from a snapshot are dict lookups, the database is only
+used for writes.
+"""
+
+import base64
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+import redis
+
+from .db import models, db_utils
+from .utils import get_config, get_logger, get_redis
+
+logger = get_logger()
+
+snapshot_prefix = 'beam::lbproxy::snapshot::'
+# device -> version of its last change, blob or delta
+versions_key = snapshot_prefix + 'versions'
+# device -> version of its published blob
+bases_key = snapshot_prefix + 'bases'
+# device -> last version handed out to a publisher
+counters_key = snapshot_prefix + 'counters'
+# device -> its compressed blob
+blob_prefix = snapshot_prefix + 'blob::'
+# device -> sorted set of the deltas published after its blob, by version
+delta_prefix = snapshot_prefix + 'deltas::'
+
+# Attribute of a member holding each dimension name
+_fields = {
+    'partition': 'partition',
+    'pool': 'pool',
+    'nodename': 'node',
+}
+
+
+def is_enabled():
+    return get_config('lbproxyd', 'read_backend', 'sql') == 'snapshot'
+
+
+class Member(object):
+    """One poolmember of a device snapshot"""
+
+    __slots__ = ('partition', 'pool', 'node', 'port', 'status')
+
+    def __init__(self, partition, pool, node, port, status):
+        self.partition = partition
+        self.pool = pool
+        self.node = node
+        self.port = port
+        self.status = status
+
+
+class DeviceSnapshot(object):
+    """The immutable poolmembers of one device, indexed by dimension
+
+    base is the version of the blob the snapshot was loaded from, version
+    the one of the last delta applied on top of it.
+    """
+
+    __slots__ = ('device', 'version', 'base', 'members', 'by_pool',
+                 'by_partition', 'by_node')
+
+    def __init__(self, device, version, rows, base=None):
+        self.device = device
+        self.version = version
+        self.base = version if base is None else base
+        self.members = []
+        self.by_pool = {}
+        self.by_partition = {}
+        self.by_node = {}
+        for partition, pool, node, port, status in rows:
+            member = Member(sys.intern(partition), sys.intern(pool),
+                            sys.intern(node), port, bool(status))
+            self.members.append(member)
+            self.by_pool.setdefault(member.pool, {})[member.node] = member
+            self.by_partition.setdefault(member.partition, []).append(member)
+            self.by_node.setdefault(member.node, []).append(member)
+
+    def member(self, pool, node):
+        return self.by_pool.get(pool, {}).get(node)
+
+    def select(self, **filters):
+        """Members matching dimension names, looked up by the best index"""
+        filters.pop('device', None)
+        if 'pool' in filters:
+            members = self.by_pool.get(filters.pop('pool'), {}).values()
+        elif 'nodename' in filters:
+            members = self.by_node.get(filters.pop('nodename'), ())
+        elif 'partition' in filters:
+            members = self.by_partition.get(filters.pop('partition'), ())
+        else:
+            members = self.members
+        return [member for member in members
+                if all(getattr(member, _fields[name]) == value
+                       for name, value in filters.items())]
+
+    def names(self, field, **filters):
+        """Distinct names of one dimension among the matching members"""
+        if field == 'device':
+            return [self.device] if self.select(**filters) else []
+        return list({getattr(member, _fields[field])
+                     for member in self.select(**filters)})
+
+    def rows(self, **filters):
+        """(partition, pool, nodename, status) of the matching members"""
+        return [(member.partition, member.pool, member.node, member.status)
+                for member in self.select(**filters)]
+
+    def patched(self, version, deltas):
+        """A copy of the snapshot with deltas applied, in order"""
+        members = {
+            (member.pool, member.node): (member.partition, member.pool,
+                                         member.node, member.port,
+                                         member.status)
+            for member in self.members
+        }
+        for delta in deltas:
+            for pool, node in delta['removed']:
+                members.pop((pool, node), None)
+            for pool, node, port, enabled in delta['added']:
+                members[(pool, node)] = (
+                    '/{}'.format(pool.split('/')[1]), pool, node, port,
+                    enabled
+                )
+        return DeviceSnapshot(self.device, version, members.values(),
+                              self.base)
+
+
+# Redis replies are decoded, blobs are compressed then base64 encoded
+def _dumps(device, version, rows):
+    return base64.b64encode(zlib.compress(json.dumps({
+        'device': device, 'version': version, 'rows': rows
+    }).encode('utf-8'))).decode('ascii')
+
+
+def _loads(blob):
+    data = json.loads(zlib.decompress(base64.b64decode(blob)).decode('utf-8'))
+    return DeviceSnapshot(data['device'], data['version'], data['rows'])
+
+
+def build(device):
+    """Read the rows of a device snapshot from the database"""
+    session = db_utils.get_scoped_session()
+    return [list(row) for row in models.query_poolmembers(
+        session, 'partition', 'pool', 'nodename',
+        models.PoolMemberProperty.port, models.PoolMemberProperty.status,
+        device=device
+    ).join(
+        models.PoolMemberProperty,
+        models.PoolMemberProperty.poolmember_id == models.PoolMember.id
+    )]
+
+
+def published(device):
+    """Whether a snapshot of the device was ever published"""
+    return get_redis(write=True).hexists(bases_key, device)
+
+
+def publish(device):
+    """Build the snapshot of a device and publish it to every worker
+
+    Versions are handed out before reading the database: every delta of
+    an earlier version is part of the blob and the deltas up to it are
+    dropped, the later ones are applied on top of it. A publisher never
+    replaces a blob carrying a later version than its own.
+    """
+    r = get_redis(write=True)
+    version = r.hincrby(counters_key, device, 1)
+    rows = build(device)
+    blob = _dumps(device, version, rows)
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(bases_key, versions_key)
+                base = pipe.hget(bases_key, device)
+                if base is not None and int(base) > version:
+                    logger.debug('Snapshot {} of {} is outdated'.format(
+                        version, device
+                    ))
+                    return False
+                current = pipe.hget(versions_key, device)
+                pipe.multi()
+                pipe.set(blob_prefix + device, blob)
+                pipe.hset(bases_key, device, version)
+                if current is None or int(current) < version:
+                    pipe.hset(versions_key, device, version)
+                pipe.zremrangebyscore(delta_prefix + device, '-inf', version)
+                pipe.execute()
+                break
+            except redis.WatchError:
+                continue
+
+    _reload(device)
+    logger.debug('Published snapshot {} of {} with {} poolmembers'.format(
+        version, device, len(rows)
+    ))
+    return True
+
+
+def apply(device, added=(), removed=()):
+    """Publish committed changes of poolmembers of a device as a delta
+
+    added holds (pool, node, port, enabled) of created or updated members
+    and removed (pool, node) of deleted ones. The database is not read,
+    unless the device was never published or snapshot_deltas deltas piled
+    up since its blob: its whole snapshot is published instead.
+    """
+    delta = {'added': [list(member[:4]) for member in added],
+             'removed': [list(member[:2]) for member in removed]}
+    if not (delta['added'] or delta['removed']):
+        return
+    r = get_redis(write=True)
+    log = delta_prefix + device
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                # The version of a delta is handed out with it, workers
+                # seeing a version find every delta up to it
+                pipe.watch(counters_key)
+                if not pipe.hexists(bases_key, device):
+                    pipe.reset()
+                    publish(device)
+                    return
+                delta['version'] = int(
+                    pipe.hget(counters_key, device) or 0) + 1
+                pipe.multi()
+                pipe.hset(counters_key, device, delta['version'])
+                pipe.zadd(log, {json.dumps(delta): delta['version']})
+                pipe.hset(versions_key, device, delta['version'])
+                pipe.zcard(log)
+                size = pipe.execute()[-1]
+                break
+            except redis.WatchError:
+                continue
+
+    if size > get_config('lbproxyd', 'snapshot_deltas', 1000, cast=int):
+        publish(device)
+    else:
+        _reload(device)
+
+
+# Snapshots loaded by this process, replaced as a whole on every change
+_devices = {}
+_devices_pid = None
+_devices_lock = threading.Lock()
+
+
+def _reload(device):
+    """Bring a device changed by this process up to date in it"""
+    if _devices_pid != os.getpid():
+        return
+    try:
+        refresh([device])
+    except Exception as e:
+        logger.error('Loading the snapshot of {} failed: {}'.format(
+            device, e
+        ))
+
+
+def _swap(changed, removed=()):
+    global _devices
+    with _devices_lock:
+        devices = dict(_devices)
+        for device, snapshot in changed.items():
+            current = devices.get(device)
+            if current is None or (current.base, current.version) < \
+                    (snapshot.base, snapshot.version):
+                devices[device] = snapshot
+        for device in removed:
+            devices.pop(device, None)
+        _devices = devices
+
+
+def refresh(only=None):
+    """Load the devices whose published version changed
+
+    Only the devices in only are looked at when it is given.
+    """
+    r = get_redis(write=True)
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(versions_key)
+    pipe.hgetall(bases_key)
+    published, bases = pipe.execute()
+    devices = _devices
+    changed = {}
+    for device, version in published.items():
+        if only is not None and device not in only:
+            continue
+        version = int(version)
+        base = int(bases.get(device, 0))
+        snapshot = devices.get(device)
+        if snapshot is not None and snapshot.base >= base and \
+                snapshot.version >= version:
+            continue
+        if snapshot is None or snapshot.base < base:
+            blob = r.get(blob_prefix + device)
+            if blob is None:
+                continue
+            snapshot = _loads(blob)
+        if snapshot.version < version:
+            deltas = r.zrangebyscore(delta_prefix + device,
+                                     snapshot.version + 1, version)
+            snapshot = snapshot.patched(
+                version, [json.loads(delta) for delta in deltas]
+            )
+        changed[device] = snapshot
+    removed = [device for device in devices if device not in published and
+               (only is None or device in only)]
+    if changed or removed:
+        _swap(changed, removed)
+
+
+def _poll():
+    interval = get_config('lbproxyd', 'snapshot_poll', 1, cast=float)
+    while True:
+        time.sleep(interval)
+        try:
+            refresh()
+        except Exception as e:
+            logger.error('Refreshing the snapshots failed: %s' % e)
+
+
+def get_device(device):
+    """Return the loaded snapshot of a device, None if it has none
+
+    A device published since the last poll is loaded first, answers read
+    after a change is published never come from the previous snapshot.
+    """
+    global _devices, _devices_pid
+    if _devices_pid != os.getpid():
+        with _devices_lock:
+            if _devices_pid != os.getpid():
+                _devices = {}
+                _devices_pid = os.getpid()
+                poller = threading.Thread(target=_poll)
+                poller.daemon = True
+                poller.start()
+        try:
+            refresh()
+        except Exception as e:
+            logger.error('Loading the snapshots failed: %s' % e)
+    current = _devices.get(device)
+    try:
+        version = get_redis(write=True).hget(versions_key, device)
+        if version is not None and (current is None or
+                                    current.version < int(version)):
+            refresh([device])
+            current = _devices.get(device)
+    except Exception as e:
+        logger.error('Loading the snapshot of {} failed: {}'.format(
+            device, e
+        ))
+    return current
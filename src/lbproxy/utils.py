@@ -12,20 +12,27 @@
 #
 # @author: Juliano Martinez (ncode)
 
+import collections
 import copy
 import configparser
+import email.utils
 import hashlib
 import inspect
 import json
+import math
 import os
 import re
 import socket
 import syslog
+import threading
+import time
+import types
+import uuid
 from functools import wraps
 from io import TextIOWrapper
 
 import redis
-from bottle import response, request, abort
+from bottle import response, request, abort, parse_date
 from .exceptions import (
     NotSelected
 )
@@ -36,7 +43,7 @@ logger = None
 caller = inspect.stack()[-1][1].split('/')[-1]
 
 config = configparser.SafeConfigParser()
-config_file = "/etc/lbproxy/lbproxy.cfg"
+config_file = os.environ.get('LBPROXY_CONFIG', "/etc/lbproxy/lbproxy.cfg")
 
 if os.path.isfile(config_file):
     config.read(config_file)
@@ -78,33 +85,384 @@ class SyslogWrapper(object):
             syslog.syslog(syslog.LOG_DEBUG, msg)
 
 
-def cache_call(f):
+class LRUCache(object):
+    """A bounded, thread safe mapping whose entries expire after ttl seconds
+
+    Values are shared between callers and must be treated as read-only.
+    """
+
+    missing = object()
+
+    def __init__(self, size=4096, ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return self.missing
+            value, expires = item
+            if expires < time.time():
+                del self._data[key]
+                return self.missing
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+cache_prefix = 'beam::lbproxy::cache::'
+invalidation_channel = 'beam::lbproxy::invalidate'
+
+# In-process cache in front of redis, rebuilt after a fork together with
+# the thread listening for invalidations
+_l1 = None
+_l1_pid = None
+_l1_lock = threading.Lock()
+
+
+def _listen_invalidations(l1):
+    while True:
+        try:
+            pubsub = get_redis(write=True).pubsub(
+                ignore_subscribe_messages=True
+            )
+            pubsub.subscribe(invalidation_channel)
+            # Anything published while we were not listening is lost
+            l1.clear()
+            for message in pubsub.listen():
+                keys = json.loads(message['data'])
+                if keys == '*':
+                    l1.clear()
+                else:
+                    l1.delete(keys)
+        except Exception as e:
+            logger.error('Listening for cache invalidations failed: %s' % e)
+            time.sleep(1)
+
+
+def get_l1_cache():
+    global _l1, _l1_pid
+    with _l1_lock:
+        if _l1_pid != os.getpid():
+            _l1 = LRUCache(
+                size=get_config('lbproxyd', 'l1_cache_size', 4096, cast=int),
+                ttl=get_config('lbproxyd', 'l1_cache_ttl', 5, cast=float)
+            )
+            _l1_pid = os.getpid()
+            listener = threading.Thread(
+                target=_listen_invalidations, args=(_l1,)
+            )
+            listener.daemon = True
+            listener.start()
+        return _l1
+
+
+def scope_tag(device, partition=None, pool=None, poolmember=None):
+    """Tag of a cached result covering one device, partition, pool or member"""
+    if poolmember:
+        return 'poolmember::%s::%s::%s' % (device, pool, poolmember)
+    if pool:
+        return 'pool::%s::%s' % (device, pool)
+    if partition:
+        return 'partition::%s::%s' % (device, partition)
+    return 'device::%s' % device
+
+
+def poolmember_tags(device, pool, poolmember):
+    """Tags of every cached result a change of the poolmember affects"""
+    partition = '/{}'.format(pool.split('/')[1])
+    return [
+        scope_tag(device),
+        scope_tag(device, partition=partition),
+        scope_tag(device, pool=pool),
+        scope_tag(device, pool=pool, poolmember=poolmember),
+    ]
+
+
+def invalidate_cache(keys=None):
+    """Drop cached results from redis and from the cache of every process
+
+    Without keys every result cached by cache_call is dropped.
+    """
+    rw = get_redis(write=True)
+    if keys is None:
+        pipe = rw.pipeline()
+        for key in rw.scan_iter(cache_prefix + '*', count=1000):
+            pipe.delete(key)
+        pipe.publish(invalidation_channel, json.dumps('*'))
+        pipe.execute()
+    elif keys:
+        keys = list(keys)
+        pipe = rw.pipeline()
+        pipe.delete(*keys)
+        pipe.publish(invalidation_channel, json.dumps(keys))
+        pipe.execute()
+
+
+def invalidate_tags(tags):
+    """Drop every cached result recorded under any of the tags
+
+    The generations of the device, partition and pool tags are bumped
+    first, so cache_call() does not store results computed before the
+    change once they are dropped.
+    """
+    scopes = set(tags)
+    tags = ['%stag::%s' % (cache_prefix, tag) for tag in scopes]
+    if not tags:
+        return
+    bump_generations(scopes)
+    try:
+        rw = get_redis(write=True)
+        keys = set()
+        for i in range(0, len(tags), 500):
+            pipe = rw.pipeline()
+            for tag in tags[i:i + 500]:
+                pipe.smembers(tag)
+            for members in pipe.execute():
+                keys.update(members)
+        invalidate_cache(list(keys) + tags)
+    except Exception as e:
+        logger.error('Could not invalidate cache tags %s: %s' % (tags, e))
+
+
+# scope_tag() -> number of changes of that scope, plus a random epoch
+# telling the counters apart from the ones of a wiped redis
+generation_key = 'beam::lbproxy::generation'
+epoch_field = '::epoch'
+# scope_tag() -> unix time of its last change
+modified_key = 'beam::lbproxy::modified'
+
+
+def _generation_fields(tags):
+    """Counted tags the generations of tags are read from
+
+    Poolmembers have no counter of their own, every change of one also
+    bumps its pool.
+    """
+    fields = set()
+    for tag in tags:
+        if tag.startswith('poolmember::'):
+            tag = 'pool::%s::%s' % tuple(tag.split('::')[1:3])
+        fields.add(tag)
+    return sorted(fields)
+
+
+def bump_generations(tags):
+    """Count a change of every device, partition and pool tag"""
+    tags = [tag for tag in set(tags) if not tag.startswith('poolmember::')]
+    if not tags:
+        return
+    try:
+        now = time.time()
+        pipe = get_redis(write=True).pipeline(transaction=False)
+        pipe.hsetnx(generation_key, epoch_field, uuid.uuid4().hex[:8])
+        for tag in tags:
+            pipe.hincrby(generation_key, tag, 1)
+        pipe.hmset(modified_key, {tag: now for tag in tags})
+        pipe.execute()
+    except Exception as e:
+        logger.error('Could not bump the generations of %s: %s' % (tags, e))
+
+
+def generation(tag):
+    """Return (ETag, last modified unix time) of a scope_tag()
+
+    Scopes that never changed since the epoch was set have generation 0
+    and no modification time; None is returned when the epoch is unset.
+    """
+    pipe = get_redis(write=False).pipeline(transaction=False)
+    pipe.hmget(generation_key, [epoch_field, tag])
+    pipe.hget(modified_key, tag)
+    (epoch, count), modified = pipe.execute()
+    if epoch is None:
+        get_redis(write=True).hsetnx(
+            generation_key, epoch_field, uuid.uuid4().hex[:8])
+        return None
+    return ('%s-%s' % (epoch, count or 0),
+            float(modified) if modified is not None else None)
+
+
+def _recently_changed(modified):
+    """Tell whether a change at any of the modified unix times may not
+    have reached the database replicas yet"""
+    lag = get_config('lbproxyd', 'replica_lag', 5, cast=float)
+    now = time.time()
+    return any(float(at) + lag > now for at in modified if at is not None)
+
+
+def _read_primary():
+    """Send the next reads of the session of this thread to the primary
+
+    Answers filled right after a change would otherwise be read from a
+    replica lagging behind it, then cached and tagged with the ETag of
+    the change.
+    """
+    from .db import db_utils
+    db_utils.get_scoped_session().info['force_primary'] = True
+
+
+def conditional(tag):
+    """Answer 304 to GETs whose If-None-Match is the current ETag
+
+    tag is called with the arguments of the handler and returns the
+    scope_tag() its answer depends on. Answers carry the ETag and
+    Last-Modified of the scope and vary on Accept; 304 is answered from
+    redis alone.
+    """
+    def decorator(f):
+        @wraps(f)
+        def revalidate(*args, **kwargs):
+            try:
+                current = generation(tag(*args, **kwargs))
+            except Exception as e:
+                logger.error('Could not read the generation: %s' % e)
+                current = None
+            if current is None:
+                return f(*args, **kwargs)
+
+            etag, modified = current
+            if _recently_changed([modified]):
+                _read_primary()
+            # Every variant of the answer, picked by the query string or
+            # the negotiated format, has its own ETag
+            variant = request.query_string
+            accept = request.get_header('Accept')
+            if accept:
+                variant = '%s|%s' % (variant, accept)
+            if variant:
+                etag = '%s-%s' % (etag, hashlib.md5(
+                    variant.encode('utf-8')).hexdigest()[:8])
+            etag = '"%s"' % etag
+            response.set_header('ETag', etag)
+            response.set_header('Vary', 'Accept')
+            if modified is not None:
+                response.set_header('Last-Modified', email.utils.formatdate(
+                    modified, usegmt=True))
+
+            matches = request.get_header('If-None-Match')
+            if matches is not None:
+                if matches.strip() == '*' or etag in [
+                        match.strip().lstrip('W/')
+                        for match in matches.split(',')]:
+                    response.status = 304
+                    return ''
+            elif modified is not None:
+                since = parse_date(request.get_header('If-Modified-Since')
+                                   or '')
+                if since is not None and int(modified) <= since:
+                    response.status = 304
+                    return ''
+            return f(*args, **kwargs)
+
+        return revalidate
+
+    return decorator
+
+
+def cache_call(f=None, tags=None):
+    """Cache the JSON result of f in memory and in redis
+
+    tags is called with the arguments of f and returns the scope_tag()s
+    the result depends on, so invalidate_tags() can drop it on changes.
+    """
+    if f is None:
+        return lambda f: cache_call(f, tags=tags)
+
     @wraps(f)
     def caching(*args, **kwargs):
+        _hash = "%s%s-%s" % (cache_prefix, f.__name__, hashlib.md5((
+            "%s%s" % (repr(args), repr(kwargs))
+        ).encode('utf-8')).hexdigest())
+        l1 = get_l1_cache()
+        result = l1.get(_hash)
+        if result is not l1.missing:
+            logger.debug('Returning result for %s from memory' % str(f))
+            return result
+
         try:
-            ro = get_redis()
-            rw = get_redis(write=True)
-            _hash = "%s-%s" % (f.__name__, hashlib.md5("%s%s" % (
-                repr(args),
-                repr(kwargs)
-            )).hexdigest())
             logger.debug('Trying to read result for %s from cache' % str(f))
-            cache = ro.get(_hash)
-            if not cache:
-                logger.debug('No cache found for %s' % str(f))
-                cache = json.dumps(f(*args, **kwargs))
-                logger.debug('Caching result for %s' % str(f))
-                rw.set(_hash, cache)
-                rw.expire(_hash, config.getint('lbproxyd', 'redis_ttl'))
-            logger.debug('Returning result for %s from cache' % str(f))
-            return json.loads(cache)
+            cache = get_redis().get(_hash)
         except Exception as e:
+            if isinstance(e, redis.exceptions.ConnectionError):
+                reset_redis()
             logger.error(
                 'Making a call without cache, cache '
-                'call from %s failed with: %s' % (str(f), e.__str__)
+                'call from %s failed with: %s' % (str(f), e)
             )
             return f(*args, **kwargs)
 
+        if cache is not None:
+            logger.debug('Returning result for %s from cache' % str(f))
+            result = json.loads(cache)
+            l1.set(_hash, result)
+            return result
+
+        logger.debug('No cache found for %s' % str(f))
+        scopes = tags(*args, **kwargs) if tags else []
+        fields = _generation_fields(scopes)
+        try:
+            rw = get_redis(write=True)
+            before = rw.hmget(generation_key, fields) if fields else None
+            if fields and _recently_changed(rw.hmget(modified_key, fields)):
+                _read_primary()
+        except Exception as e:
+            logger.error('Could not read the generations of %s: %s' % (
+                str(f), e
+            ))
+            return f(*args, **kwargs)
+
+        result = f(*args, **kwargs)
+        try:
+            logger.debug('Caching result for %s' % str(f))
+            ttl = config.getint('lbproxyd', 'redis_ttl')
+            with rw.pipeline() as pipe:
+                # A change committed while f ran bumped a generation, its
+                # result may predate the change and is not stored
+                if fields:
+                    pipe.watch(generation_key)
+                    if pipe.hmget(generation_key, fields) != before:
+                        logger.debug('Not caching the outdated result of %s'
+                                     % str(f))
+                        return result
+                pipe.multi()
+                pipe.set(_hash, json.dumps(result), ex=ttl)
+                for tag in scopes:
+                    tag = '%stag::%s' % (cache_prefix, tag)
+                    pipe.sadd(tag, _hash)
+                    pipe.expire(tag, ttl)
+                pipe.execute()
+        except redis.WatchError:
+            logger.debug('Not caching the outdated result of %s' % str(f))
+            return result
+        except Exception as e:
+            if isinstance(e, redis.exceptions.ConnectionError) or \
+                    'READONLY' in str(e):
+                reset_redis()
+            logger.error(
+                'Could not cache the result of %s: %s' % (str(f), e)
+            )
+            return result
+        l1.set(_hash, result)
+        return result
+
     return caching
 
 
@@ -117,28 +475,99 @@ def get_logger():
     return logger
 
 
-def get_redis(write=False):
-    if config.getboolean('lbproxyd', 'redis_is_sentinel'):
-        port = config.getint('lbproxyd', 'redis_port')
-        hosts = [(host, port) for host in
-                 config.get('lbproxyd', 'redis_host').split()]
+# Redis clients are shared by every caller of a process and rebuilt after
+# a fork, their connection pools keep the sockets open between calls
+_redis = {}
+_redis_pid = None
+_redis_lock = threading.Lock()
 
-        sentinel = Sentinel(
-            hosts, socket_timeout=5,
-            decode_responses=True
-        )
+
+def _new_redis(write):
+    if config.getboolean('lbproxyd', 'redis_is_sentinel'):
+        if 'sentinel' not in _redis:
+            port = config.getint('lbproxyd', 'redis_port')
+            hosts = [(host, port) for host in
+                     config.get('lbproxyd', 'redis_host').split()]
+            _redis['sentinel'] = Sentinel(
+                hosts, socket_timeout=5,
+                decode_responses=True
+            )
+        # The sentinel pools look the master or a slave up again
+        # whenever a connection to the current one fails
         if write:
-            return sentinel.master_for('beam')
+            return _redis['sentinel'].master_for('beam')
         else:
-            return sentinel.slave_for('beam')
+            return _redis['sentinel'].slave_for('beam')
     else:
-        r = redis.Redis(
+        return redis.Redis(
             host=config.get('lbproxyd', 'redis_host'),
             port=config.getint('lbproxyd', 'redis_port'),
             db=config.getint('lbproxyd', 'redis_db'),
             decode_responses=True
         )
-        return r
+
+
+def get_redis(write=False):
+    global _redis, _redis_pid
+    with _redis_lock:
+        if _redis_pid != os.getpid():
+            _redis = {}
+            _redis_pid = os.getpid()
+        if not config.getboolean('lbproxyd', 'redis_is_sentinel'):
+            write = True
+        if write not in _redis:
+            _redis[write] = _new_redis(write)
+        return _redis[write]
+
+
+def reset_redis():
+    """Drop the cached clients, the next get_redis() discovers again"""
+    global _redis
+    with _redis_lock:
+        _redis = {}
+
+
+def take_slot(key, limit, timeout):
+    """Take one of limit slots kept in a redis sorted set
+
+    Every holder adds a token scored by its deadline, tokens past their
+    deadline, left by processes that died, are dropped first. Returns
+    the token to give to release_slot(), or None when every slot is
+    taken.
+    """
+    token = uuid.uuid4().hex
+    now = time.time()
+    rw = get_redis(write=True)
+    pipe = rw.pipeline()
+    pipe.zremrangebyscore(key, '-inf', now)
+    pipe.zadd(key, {token: now + timeout})
+    pipe.zrank(key, token)
+    pipe.expire(key, int(math.ceil(timeout)) + 1)
+    rank = pipe.execute()[2]
+    if rank is None or rank >= limit:
+        rw.zrem(key, token)
+        return None
+    return token
+
+
+def renew_slot(key, token, timeout):
+    """Push the deadline of a slot still in use"""
+    rw = get_redis(write=True)
+    pipe = rw.pipeline()
+    pipe.zadd(key, {token: time.time() + timeout}, xx=True)
+    pipe.expire(key, int(math.ceil(timeout)) + 1)
+    pipe.execute()
+
+
+def release_slot(key, token):
+    get_redis(write=True).zrem(key, token)
+
+
+# Authentication plugins loaded by this process, by name
+_auth_plugins = {}
+_auth_lock = threading.Lock()
+# (user, sha256 of the key) -> (verdict, expiry)
+_verdicts = {}
 
 
 def handle_auth(f):
@@ -146,11 +575,7 @@ def handle_auth(f):
     def authenticate(*args, **kwargs):
         if not config.getboolean('lbproxyd', 'authentication'):
             return f(*args, **kwargs)
-        authentication_plugin = config.get(
-            'authentication', 'authentication_plugin'
-        )
-        auth = load_auth_plugin(authentication_plugin)
-        if auth.do(request):
+        if authenticated(request):
             return f(*args, **kwargs)
         else:
             abort(403, 'Access denied')
@@ -158,18 +583,73 @@ def handle_auth(f):
     return authenticate
 
 
+def authenticated(request):
+    """Ask the authentication plugin about a request, caching its verdict
+
+    Verdicts are kept verdict_ttl seconds for the X-Beam-User and the hash
+    of the X-Beam-Key of the request.
+    """
+    user = request.headers.get('X-Beam-User')
+    key = request.headers.get('X-Beam-Key')
+    ttl = get_config('authentication', 'verdict_ttl', 5, cast=float)
+    now = time.time()
+    cache_key = None
+    if user is not None and key is not None and ttl > 0:
+        cache_key = (user, hashlib.sha256(key.encode('utf-8')).digest())
+        cached = _verdicts.get(cache_key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+    auth = load_auth_plugin(config.get(
+        'authentication', 'authentication_plugin'
+    ))
+    try:
+        verdict = bool(auth.do(request))
+    except Exception as e:
+        logger.error('Problem authenticating: %s' % e)
+        return False
+
+    if cache_key is not None:
+        if len(_verdicts) >= 10000:
+            _verdicts.clear()
+        _verdicts[cache_key] = (verdict, now + ttl)
+    return verdict
+
+
 def load_auth_plugin(plugin):
-    logger.debug('Loading authentication plug-in %s' % plugin)
-    _module_ = 'lbproxy.auth.%s' % plugin
-    module = __import__(_module_)
-    module = getattr(module.auth, plugin)
-    return module.Auth()
+    """Return the authentication plugin of that name, loaded once"""
+    auth = _auth_plugins.get(plugin)
+    if auth is not None:
+        return auth
+    with _auth_lock:
+        if plugin not in _auth_plugins:
+            logger.debug('Loading authentication plug-in %s' % plugin)
+            _module_ = 'lbproxy.auth.%s' % plugin
+            module = __import__(_module_)
+            module = getattr(module.auth, plugin)
+            _auth_plugins[plugin] = module.Auth()
+        return _auth_plugins[plugin]
+
+
+def clear_auth_cache():
+    _verdicts.clear()
+
+
+def reload_auth():
+    """Reload the credentials of the loaded authentication plugins"""
+    for auth in list(_auth_plugins.values()):
+        if hasattr(auth, 'reload'):
+            auth.reload()
+    clear_auth_cache()
 
 
 def reply_json(f):
     @wraps(f)
     def json_dumps(*args, **kwargs):
         r = f(*args, **kwargs)
+        if isinstance(r, types.GeneratorType):
+            # Streamed answer, the handler already set its content type
+            return r
         response.content_type = 'application/json; charset=UTF-8'
         if r and type(r) in (dict, list, tuple):
             return json.dumps(r)
@@ -179,6 +659,193 @@ def reply_json(f):
     return json_dumps
 
 
+class _Flight(object):
+    """One computation of an answer and the requests waiting for it"""
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# (method, path, query, accept) -> _Flight of the answers being computed
+_flights = {}
+_flights_lock = threading.Lock()
+flight_prefix = 'beam::lbproxy::flight::'
+
+
+def _answer(body):
+    """(status, content type, body) of the answer of the current request"""
+    return [response.status_line, response.content_type, body]
+
+
+def _share(result):
+    status, content_type, body = result
+    response.status = status
+    response.content_type = content_type
+    return body
+
+
+def _fly(key, compute):
+    """Run compute() once for the workers waiting on the same key
+
+    The first worker taking the redis lock computes the answer and
+    leaves it under the token of the lock; the others poll for it while
+    the lock is held and compute it themselves if it never shows up.
+    """
+    wait = get_config('lbproxyd', 'single_flight_wait', 10, cast=float)
+    lock = '%slock::%s' % (flight_prefix, hashlib.md5(
+        repr(key).encode('utf-8')).hexdigest())
+    token = uuid.uuid4().hex
+    try:
+        r = get_redis(write=True)
+        leader = r.set(lock, token, nx=True, px=int(wait * 1000))
+    except Exception as e:
+        logger.error('Single flight lock failed: %s' % e)
+        return compute()
+
+    if leader:
+        try:
+            result = compute()
+            if result[2] is None or isinstance(result[2], str):
+                r.set(flight_prefix + token, json.dumps(result),
+                      px=int(wait * 1000))
+            return result
+        finally:
+            try:
+                if r.get(lock) == token:
+                    r.delete(lock)
+            except Exception as e:
+                logger.error('Single flight unlock failed: %s' % e)
+
+    deadline = time.time() + wait
+    try:
+        token = r.get(lock)
+        while token is not None and time.time() < deadline:
+            shared = r.get(flight_prefix + token)
+            if shared is not None:
+                return json.loads(shared)
+            time.sleep(0.01)
+            if r.get(lock) != token:
+                shared = r.get(flight_prefix + token)
+                if shared is not None:
+                    return json.loads(shared)
+                break
+    except Exception as e:
+        logger.error('Single flight wait failed: %s' % e)
+    return compute()
+
+
+def single_flight(f):
+    """Share the answer of identical concurrent requests
+
+    Requests for the same method, path, query string and Accept header,
+    which picks the format of some answers, arriving while one of them
+    is being answered wait for that answer instead of computing their
+    own; with single_flight_redis set they also wait for the ones being
+    answered by other workers. Goes between the other decorators and
+    reply_json, streamed answers are never shared.
+    """
+    @wraps(f)
+    def flying(*args, **kwargs):
+        if not config.getboolean('lbproxyd', 'single_flight', fallback=True):
+            return f(*args, **kwargs)
+
+        def compute():
+            return _answer(f(*args, **kwargs))
+
+        key = (request.method, request.path, request.query_string,
+               request.get_header('Accept', ''))
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+
+        if leader:
+            try:
+                if config.getboolean('lbproxyd', 'single_flight_redis',
+                                     fallback=False):
+                    flight.result = _fly(key, compute)
+                else:
+                    flight.result = compute()
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with _flights_lock:
+                    del _flights[key]
+                flight.event.set()
+            return _share(flight.result)
+
+        flight.event.wait(get_config('lbproxyd', 'single_flight_wait', 10,
+                                     cast=float))
+        if flight.error is not None:
+            raise flight.error
+        if flight.result is None or \
+                isinstance(flight.result[2], types.GeneratorType):
+            return f(*args, **kwargs)
+        return _share(flight.result)
+
+    return flying
+
+
+def _buffered(fragments, size=65536):
+    """Join small string fragments into chunks of about size characters"""
+    chunk = []
+    length = 0
+    for fragment in fragments:
+        chunk.append(fragment)
+        length += len(fragment)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _json_fragments(rows, depth):
+    keys = None
+    yield '{'
+    for row in rows:
+        current = tuple(row[depth:2])
+        if keys is None:
+            yield ''.join('%s: {' % json.dumps(key) for key in current)
+        elif current == keys:
+            yield ', '
+        else:
+            common = 0
+            while current[common] == keys[common]:
+                common += 1
+            yield '}' * (len(keys) - common) + ', '
+            yield ''.join('%s: {' % json.dumps(key)
+                          for key in current[common:])
+        yield '%s: %s' % (json.dumps(row[2]), json.dumps(
+            {"status": "enabled" if row[3] else "disabled"}))
+        keys = current
+    yield '}' * (len(keys) if keys is not None else 0) + '}'
+
+
+def stream_json(rows, depth):
+    """Encode (partition, pool, nodename, status) rows as a nested object
+
+    rows must be ordered by partition, pool and nodename; the answer is
+    the one of _status_tree() with the same depth, produced in chunks.
+    """
+    return _buffered(_json_fragments(rows, depth))
+
+
+def stream_ndjson(rows):
+    """Encode (partition, pool, nodename, status) rows one per line"""
+    return _buffered(json.dumps({
+        "partition": row[0], "pool": row[1], "poolmember": row[2],
+        "status": "enabled" if row[3] else "disabled"
+    }) + '\n' for row in rows)
+
+
 def validate_loadbalancer_host(f):
     @wraps(f)
     def validate(*args, **kwargs):
@@ -250,7 +917,7 @@ def has_attr(src, msg):
 def get_config(section, key, default=None, parser=config, cast=None):
     try:
         val = parser.get(section, key)
-    except configparser.NoOptionError:
+    except (configparser.NoOptionError, configparser.NoSectionError):
         return default
     except:
         raise
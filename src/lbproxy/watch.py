@@ -0,0 +1,183 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Events of poolmember state changes, for clients watching a scope
+
+The collector and the write paths of lbproxy publish an event every time
+a poolmember is added, removed or changes state. Events of a device are
+numbered by a generation counter and kept in a capped redis log, and the
+last generation is published on a channel of the device. lbproxyd
+workers have one thread listening to every channel, waking the requests
+waiting for new events of a device.
+"""
+
+import json
+import os
+import threading
+import time
+
+import redis
+
+from .utils import get_config, get_logger, get_redis
+
+logger = get_logger()
+
+watch_prefix = 'beam::lbproxy::watch::'
+# device -> last generation handed out
+generation_prefix = watch_prefix + 'generation::'
+# device -> sorted set of its events, scored by generation
+log_prefix = watch_prefix + 'log::'
+# device -> channel carrying its last generation
+channel_prefix = watch_prefix + 'channel::'
+
+
+def _event(generation, pool, node, enabled, now):
+    if enabled is None:
+        status = 'removed'
+    else:
+        status = 'enabled' if enabled else 'disabled'
+    return {
+        'generation': generation,
+        'partition': '/{}'.format(pool.split('/')[1]),
+        'pool': pool,
+        'poolmember': node,
+        'status': status,
+        'time': now,
+    }
+
+
+def publish(device, changes):
+    """Log and announce (pool, node, enabled) changes of a device
+
+    enabled is None for removed poolmembers. Errors are logged, watchers
+    missing events find out through the generations.
+    """
+    changes = list(changes)
+    if not changes:
+        return
+    key = generation_prefix + device
+    log = log_prefix + device
+    size = get_config('lbproxyd', 'watch_log_size', 10000, cast=int)
+    now = time.time()
+    try:
+        with get_redis(write=True).pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    first = int(pipe.get(key) or 0) + 1
+                    last = first + len(changes) - 1
+                    pipe.multi()
+                    pipe.zadd(log, {
+                        json.dumps(_event(generation, pool, node, enabled,
+                                          now)): generation
+                        for generation, (pool, node, enabled)
+                        in enumerate(changes, first)
+                    })
+                    pipe.zremrangebyrank(log, 0, -size - 1)
+                    pipe.set(key, last)
+                    pipe.publish(channel_prefix + device, last)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+    except Exception as e:
+        logger.error('Publishing the changes of {} failed: {}'.format(
+            device, e
+        ))
+
+
+def generation(device):
+    """Last generation of the events of a device"""
+    return int(get_redis(write=True).get(generation_prefix + device) or 0)
+
+
+def events(device, since, partition=None, pool=None):
+    """Return (generation, events after since, reset) of a device
+
+    Only the events of the partition or pool are returned when one is
+    given. reset is True when events after since were already dropped
+    from the log, the watcher has to read the whole scope again.
+    """
+    log = log_prefix + device
+    pipe = get_redis(write=True).pipeline(transaction=False)
+    pipe.get(generation_prefix + device)
+    pipe.zrangebyscore(log, since + 1, '+inf')
+    pipe.zrange(log, 0, 0, withscores=True)
+    generation, found, oldest = pipe.execute()
+    generation = int(generation or 0)
+    if since > generation or (oldest and since < int(oldest[0][1]) - 1) or \
+            (not oldest and since < generation):
+        return generation, [], True
+
+    found = [json.loads(event) for event in found]
+    return generation, [
+        event for event in found
+        if (partition is None or event['partition'] == partition) and
+        (pool is None or event['pool'] == pool)
+    ], False
+
+
+# device -> last generation announced, for the requests of this process
+_latest = {}
+_latest_pid = None
+_latest_cond = threading.Condition()
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = get_redis(write=True).pubsub(
+                ignore_subscribe_messages=True
+            )
+            pubsub.psubscribe(channel_prefix + '*')
+            for message in pubsub.listen():
+                device = message['channel'][len(channel_prefix):]
+                with _latest_cond:
+                    _latest[device] = max(int(message['data']),
+                                          _latest.get(device, 0))
+                    _latest_cond.notify_all()
+        except Exception as e:
+            logger.error('Listening for watch events failed: %s' % e)
+            time.sleep(1)
+
+
+def _announced(device, since, timeout):
+    """Wait up to timeout seconds for a generation past since"""
+    global _latest, _latest_pid
+    with _latest_cond:
+        if _latest_pid != os.getpid():
+            _latest = {}
+            _latest_pid = os.getpid()
+            listener = threading.Thread(target=_listen)
+            listener.daemon = True
+            listener.start()
+        return _latest_cond.wait_for(
+            lambda: _latest.get(device, 0) > since, timeout
+        )
+
+
+def wait(device, since, timeout, partition=None, pool=None):
+    """Wait up to timeout seconds for events after since in a scope
+
+    Returns like events(), with the generation the watcher continues
+    from; events of other scopes only move that generation forward.
+    """
+    deadline = time.time() + timeout
+    while True:
+        generation, found, reset = events(device, since, partition, pool)
+        remaining = deadline - time.time()
+        if found or reset or remaining <= 0:
+            return generation, found, reset
+        since = generation
+        # Messages are lost while the listener reconnects, read the log
+        # again every few seconds anyway
+        _announced(device, since, min(remaining, 5))
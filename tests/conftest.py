@@ -0,0 +1,110 @@
+"""Fixtures shared by the lbproxy tests
+
+lbproxy reads its configuration and opens its database when imported,
+so a configuration pointing at a throwaway sqlite database is written
+and named in LBPROXY_CONFIG before any test module imports it. Redis is
+replaced by fakeredis and the F5 is never reached: changes skip it or
+the tests replace the connection.
+"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix='lbproxy-tests-')
+
+CONFIG = """
+[lbproxyd]
+authentication = False
+debug          = False
+redis_host     = 127.0.0.1
+redis_port     = 6379
+redis_db       = 0
+redis_ttl      = 604800
+redis_is_sentinel = False
+database_type  = sqlite
+database_name  = %(database)s
+database_user  =
+database_pass  =
+database_host  =
+read_backend   = sql
+coalesce_window  = 0.1
+coalesce_timeout = 5
+single_flight_wait = 5
+
+[lbproxy-worker]
+device_concurrency = 1
+job_timeout    = 600
+job_attempts   = 3
+
+[f5]
+username = admin
+password = admin
+
+[authentication]
+authentication_plugin = ini_file
+"""
+
+with open(os.path.join(_tmp, 'lbproxy.cfg'), 'w') as f:
+    f.write(CONFIG % {'database': os.path.join(_tmp, 'lbproxy.db')})
+os.environ['LBPROXY_CONFIG'] = os.path.join(_tmp, 'lbproxy.cfg')
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def _fake_redis():
+    fakeredis = pytest.importorskip('fakeredis')
+    utils = pytest.importorskip('lbproxy.utils')
+    server = fakeredis.FakeServer()
+    original = utils._new_redis
+    utils._new_redis = lambda write: fakeredis.FakeStrictRedis(
+        server=server, decode_responses=True)
+    utils.reset_redis()
+    yield server
+    utils._new_redis = original
+    utils.reset_redis()
+
+
+@pytest.fixture(autouse=True)
+def redis(_fake_redis):
+    """An empty redis for every test"""
+    from lbproxy import utils
+    r = utils.get_redis(write=True)
+    r.flushall()
+    utils.get_l1_cache().clear()
+    yield r
+
+
+@pytest.fixture(autouse=True)
+def database(redis):
+    """An empty database for every test"""
+    from lbproxy import session
+    from lbproxy.db import models
+    session.remove()
+    with models.engine.begin() as connection:
+        for table in reversed(models.Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    yield session
+    session.remove()
+
+
+@pytest.fixture
+def setting():
+    """Change lbproxyd settings for one test"""
+    from lbproxy.utils import config
+    saved = {}
+
+    def change(key, value):
+        saved.setdefault(key, config.get('lbproxyd', key, fallback=None))
+        config.set('lbproxyd', key, str(value))
+    yield change
+    for key, value in saved.items():
+        if value is None:
+            config.remove_option('lbproxyd', key)
+        else:
+            config.set('lbproxyd', key, value)
@@ -0,0 +1,105 @@
+import pytest
+
+cache = pytest.importorskip('lbproxy.cache')
+
+
+def _members(device):
+    current = cache._current_poolmembers(device)
+    return {key: (value[2], bool(value[3])) for key, value in current.items()}
+
+
+def test_sync_inserts_new_poolmembers():
+    changes = cache.poolmembers('lb1', [
+        ('/P1/a', [('/Common/n1', 80, True), ('/Common/n2', 80, False)]),
+        ('/P2/b', [('/Common/n1', 443, True)]),
+    ])
+
+    assert sorted(changes['inserted']) == [
+        ('/P1/a', '/Common/n1', 80, True),
+        ('/P1/a', '/Common/n2', 80, False),
+        ('/P2/b', '/Common/n1', 443, True),
+    ]
+    assert changes['updated'] == [] and changes['deleted'] == []
+    assert _members('lb1') == {
+        ('/P1/a', '/Common/n1'): (80, True),
+        ('/P1/a', '/Common/n2'): (80, False),
+        ('/P2/b', '/Common/n1'): (443, True),
+    }
+
+
+def test_sync_updates_and_deletes_in_one_pass():
+    cache.poolmembers('lb1', [
+        ('/P1/a', [('/Common/n1', 80, True), ('/Common/n2', 80, True),
+                   ('/Common/n3', 80, True)]),
+    ])
+
+    changes = cache.poolmembers('lb1', [
+        ('/P1/a', [('/Common/n1', 80, False), ('/Common/n2', 8080, True),
+                   ('/Common/n4', 80, True)]),
+    ])
+
+    assert changes['inserted'] == [('/P1/a', '/Common/n4', 80, True)]
+    assert sorted(changes['updated']) == [
+        ('/P1/a', '/Common/n1', 80, False),
+        ('/P1/a', '/Common/n2', 8080, True),
+    ]
+    assert changes['deleted'] == [('/P1/a', '/Common/n3', 80, True)]
+    assert _members('lb1') == {
+        ('/P1/a', '/Common/n1'): (80, False),
+        ('/P1/a', '/Common/n2'): (8080, True),
+        ('/P1/a', '/Common/n4'): (80, True),
+    }
+
+
+def test_sync_without_changes_writes_nothing():
+    pools = [('/P1/a', [('/Common/n1', 80, True)])]
+    cache.poolmembers('lb1', pools)
+
+    assert cache.poolmembers('lb1', pools) == {
+        'inserted': [], 'updated': [], 'deleted': []}
+
+
+def test_sync_keeps_other_devices():
+    cache.poolmembers('lb1', [('/P1/a', [('/Common/n1', 80, True)])])
+    cache.poolmembers('lb2', [('/P1/a', [('/Common/n1', 80, False)])])
+
+    cache.poolmembers('lb1', [])
+
+    assert _members('lb1') == {}
+    assert _members('lb2') == {('/P1/a', '/Common/n1'): (80, False)}
+
+
+def test_sync_duplicate_members_count_once():
+    changes = cache.poolmembers('lb1', [
+        ('/P1/a', [('/Common/n1', 80, True), ('/Common/n1', 80, False)]),
+    ])
+
+    assert changes['inserted'] == [('/P1/a', '/Common/n1', 80, True)]
+
+
+def test_incremental_sync_only_reconciles_changed_pools():
+    cache.poolmembers('lb1', [
+        ('/P1/a', [('/Common/n1', 80, True)]),
+        ('/P1/b', [('/Common/n2', 80, True)]),
+    ])
+
+    changes = cache.poolmembers('lb1', [
+        ('/P1/a', [('/Common/n1', 80, False)]),
+    ], full=False)
+
+    assert changes['updated'] == [('/P1/a', '/Common/n1', 80, False)]
+    assert changes['deleted'] == [('/P1/b', '/Common/n2', 80, True)]
+    assert _members('lb1') == {('/P1/a', '/Common/n1'): (80, False)}
+
+
+def test_sync_keeps_the_node_index_current():
+    from lbproxy import nodeindex
+
+    cache.poolmembers('lb1', [('/P1/a', [('/Common/n1', 80, True)])])
+    cache.poolmembers('lb1', [('/P1/a', [('/Common/n1', 80, False)]),
+                              ('/P1/b', [('/Common/n1', 81, True)])])
+
+    assert sorted(nodeindex.lookup(['/Common/n1'])['/Common/n1']) == [
+        ('lb1', '/P1', '/P1/a', 80, False),
+        ('lb1', '/P1', '/P1/b', 81, True),
+    ]
@@ -0,0 +1,139 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+coalesce = pytest.importorskip('lbproxy.coalesce')
+
+from lbproxy import Poolmember, batch, cache  # noqa: E402
+from lbproxy.exceptions import WriteTimeout  # noqa: E402
+
+KEY = 'lb1::/P1/a::/Common/n1'
+
+
+@pytest.fixture(autouse=True)
+def poolmember(database):
+    cache.poolmembers('lb1', [('/P1/a', [('/Common/n1', 80, True),
+                                         ('/Common/n2', 80, True)])])
+
+
+def _enabled():
+    from lbproxy import session
+    session.expire_all()
+    return Poolmember('/Common/n1', pool='/P1/a', device='lb1').enabled
+
+
+def _wait_for_generation(redis, generation):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        current = redis.hget(coalesce.desired_prefix + KEY, 'generation')
+        if current is not None and int(current) >= generation:
+            return
+        time.sleep(0.01)
+    raise AssertionError('changes were not recorded')
+
+
+def test_uncontended_change_is_written_right_away(setting):
+    setting('coalesce_window', 5)
+    started = time.time()
+
+    state, wrote = coalesce.submit('lb1', '/P1/a', '/Common/n1', False,
+                                   skip_f5=True)
+
+    assert (state, wrote) == (False, True)
+    assert time.time() - started < 1
+    assert _enabled() is False
+
+
+def test_change_to_the_current_state_writes_nothing():
+    assert coalesce.submit('lb1', '/P1/a', '/Common/n1', True,
+                           skip_f5=True) == (True, False)
+    assert coalesce.stats() == {'requested': 1, 'written': 0, 'saved': 1}
+
+
+def test_waiter_returns_once_its_change_is_applied(redis):
+    redis.set(coalesce.lock_prefix + KEY, 'other')
+    redis.hmset(coalesce.applied_prefix + KEY,
+                {'generation': 100, 'state': 0})
+
+    assert coalesce.submit('lb1', '/P1/a', '/Common/n1', True,
+                           skip_f5=True) == (False, False)
+    assert _enabled() is True
+
+
+def test_concurrent_changes_collapse_to_the_latest(redis):
+    # Hold the lock while the changes pile up behind it
+    redis.set(coalesce.lock_prefix + KEY, 'other')
+    results = []
+    threads = [threading.Thread(target=lambda state=state: results.append(
+        coalesce.submit('lb1', '/P1/a', '/Common/n1', state, skip_f5=True)))
+        for state in [False, True, False, True, False]]
+    for thread in threads:
+        thread.start()
+    _wait_for_generation(redis, len(threads))
+    latest = redis.hget(coalesce.desired_prefix + KEY, 'state') == '1'
+    redis.delete(coalesce.lock_prefix + KEY)
+    for thread in threads:
+        thread.join()
+
+    assert {state for state, wrote in results} == {latest}
+    assert sum(wrote for state, wrote in results) <= 1
+    assert _enabled() is latest
+    stats = coalesce.stats()
+    assert stats['requested'] == 5 and stats['written'] <= 1
+
+
+def test_change_times_out_behind_a_held_lock(redis, setting):
+    setting('coalesce_timeout', 0.2)
+    redis.set(coalesce.lock_prefix + KEY, 'other')
+
+    with pytest.raises(WriteTimeout):
+        coalesce.submit('lb1', '/P1/a', '/Common/n1', False, skip_f5=True)
+    assert _enabled() is True
+
+
+def test_batch_waits_for_the_lock_of_its_poolmembers(redis, monkeypatch):
+    written = []
+
+    class Member(object):
+        def __init__(self, name):
+            self.name = name
+
+        @property
+        def enabled(self):
+            return True
+
+        @enabled.setter
+        def enabled(self, state):
+            written.append((self.name, state))
+
+    class Lb(object):
+        pool_get = node_get = staticmethod(Member)
+
+        def pm_get(self, node, port, pool):
+            return Member(node.name)
+
+    @contextmanager
+    def f5_connection(device):
+        yield Lb()
+    monkeypatch.setattr(batch, 'f5_connection', f5_connection)
+
+    redis.set(coalesce.lock_prefix + KEY, 'other')
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(batch.apply([
+        {'loadbalancer': 'lb1', 'partition': 'P1', 'pool': 'a',
+         'poolmember': 'n1', 'status': 'disabled'},
+        {'loadbalancer': 'lb1', 'partition': 'P1', 'pool': 'a',
+         'poolmember': 'n2', 'status': 'disabled'},
+    ])))
+    thread.start()
+    _wait_for_generation(redis, 1)
+    time.sleep(0.2)
+    assert written == []
+    redis.delete(coalesce.lock_prefix + KEY)
+    thread.join()
+
+    assert [result['result'] for result in results] == ['ok', 'ok']
+    assert sorted(written) == [('/Common/n1', False), ('/Common/n2', False)]
+    assert _enabled() is False
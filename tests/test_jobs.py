@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+jobs = pytest.importorskip('lbproxy.jobs')
+
+
+def _take(redis, job_id):
+    """Move a queued job to the processing list like a worker does"""
+    assert redis.rpoplpush(jobs.queue_key, jobs.processing_key) == job_id
+
+
+def _job():
+    return jobs.enqueue('poolmember', {
+        'device': 'lb1', 'pool': '/P1/a', 'poolmember': '/Common/n1',
+        'state': False}, ['lb1'])
+
+
+def test_recover_claims_a_job_just_taken(redis):
+    job_id = _job()
+    _take(redis, job_id)
+
+    jobs.recover()
+
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'queued' and 'claimed' in job
+    assert redis.lrange(jobs.processing_key, 0, -1) == [job_id]
+    assert redis.llen(jobs.queue_key) == 0
+
+
+def test_recover_leaves_running_jobs_alone(redis):
+    job_id = _job()
+    _take(redis, job_id)
+    redis.hmset(jobs.job_prefix + job_id,
+                {'status': 'running', 'claimed': time.time()})
+
+    jobs.recover()
+
+    assert jobs.get_job(job_id)['status'] == 'running'
+    assert redis.lrange(jobs.processing_key, 0, -1) == [job_id]
+
+
+def test_recover_queues_again_a_job_whose_claim_lapsed(redis):
+    job_id = _job()
+    _take(redis, job_id)
+    redis.hmset(jobs.job_prefix + job_id, {
+        'status': 'running', 'claimed': time.time() - 601, 'attempts': 1})
+
+    jobs.recover()
+
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'queued' and 'claimed' not in job
+    assert redis.llen(jobs.processing_key) == 0
+    assert redis.lrange(jobs.queue_key, 0, -1) == [job_id]
+
+
+def test_recover_fails_a_job_after_its_last_attempt(redis):
+    job_id = _job()
+    _take(redis, job_id)
+    redis.hmset(jobs.job_prefix + job_id, {
+        'status': 'running', 'claimed': time.time() - 601, 'attempts': 3})
+
+    jobs.recover()
+
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'The worker running the job died'
+    assert redis.llen(jobs.processing_key) == 0
+    assert redis.llen(jobs.queue_key) == 0
+
+
+def test_recover_drops_expired_jobs(redis):
+    job_id = _job()
+    _take(redis, job_id)
+    redis.delete(jobs.job_prefix + job_id)
+
+    jobs.recover()
+
+    assert redis.llen(jobs.processing_key) == 0
+    assert redis.llen(jobs.queue_key) == 0
+
+
+def test_job_of_a_busy_device_goes_back_unclaimed(redis):
+    job_id = _job()
+    tokens = jobs._acquire(['lb1'])
+    stops = iter([False, True])
+
+    try:
+        jobs.work(lambda: next(stops))
+    finally:
+        jobs._release(tokens)
+
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'queued' and 'claimed' not in job
+    assert redis.lrange(jobs.queue_key, 0, -1) == [job_id]
+    assert redis.llen(jobs.processing_key) == 0
@@ -0,0 +1,117 @@
+import http.client
+import socket
+import threading
+
+import pytest
+
+server = pytest.importorskip('lbproxy.server')
+
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    if path == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (part for part in [b'one ', b'', b'two'])
+    if path == '/unmodified':
+        start_response('304 Not Modified', [])
+        return []
+    if path == '/unread':
+        body = b''
+    answer = b'answer of ' + path.encode() + b' ' + body
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(answer)))])
+    return [answer]
+
+
+@pytest.fixture
+def address():
+    httpd = server.PooledWSGIServer(('127.0.0.1', 0), threads=2,
+                                    keepalive=2)
+    httpd.set_app(app)
+    thread = threading.Thread(target=httpd.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.start()
+    yield httpd.server_address
+    httpd.shutdown()
+    thread.join()
+    httpd.server_close()
+
+
+@pytest.fixture
+def connection(address):
+    sock = socket.create_connection(address, timeout=5)
+    yield sock
+    sock.close()
+
+
+def request(sock, path, version='HTTP/1.1', headers=(), body=b''):
+    """Send one request over sock and read its answer"""
+    lines = ['GET %s %s' % (path, version), 'Host: localhost']
+    lines.extend('%s: %s' % header for header in headers)
+    if body:
+        lines.append('Content-Length: %d' % len(body))
+    sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+    answer = http.client.HTTPResponse(sock, method='GET')
+    answer.begin()
+    return answer, answer.read()
+
+
+def closed(sock):
+    return sock.recv(1) == b''
+
+
+def test_requests_share_a_connection(connection):
+    first, body = request(connection, '/one')
+    assert (first.status, body) == (200, b'answer of /one ')
+
+    second, body = request(connection, '/two', body=b'data')
+    assert (second.status, body) == (200, b'answer of /two data')
+
+
+def test_streamed_answers_are_chunked(connection):
+    answer, body = request(connection, '/stream')
+
+    assert answer.getheader('Transfer-Encoding') == 'chunked'
+    assert answer.getheader('Content-Length') is None
+    assert body == b'one two'
+    # The connection is still usable
+    assert request(connection, '/after')[1] == b'answer of /after '
+
+
+def test_http10_streams_close_the_connection(connection):
+    answer, body = request(connection, '/stream', version='HTTP/1.0')
+
+    assert answer.getheader('Transfer-Encoding') is None
+    assert body == b'one two'
+    assert closed(connection)
+
+
+def test_answers_without_body_are_not_chunked(connection):
+    answer, body = request(connection, '/unmodified')
+
+    assert answer.status == 304
+    assert answer.getheader('Transfer-Encoding') is None
+    assert request(connection, '/after')[1] == b'answer of /after '
+
+
+def test_client_closing_the_connection(connection):
+    answer, body = request(connection, '/one',
+                           headers=[('Connection', 'close')])
+
+    assert body == b'answer of /one '
+    assert closed(connection)
+
+
+def test_unread_bodies_are_skipped(connection):
+    request(connection, '/unread', body=b'GET /smuggled HTTP/1.1\r\n\r\n')
+
+    assert request(connection, '/after')[1] == b'answer of /after '
+
+
+def test_chunked_request_bodies_are_refused(connection):
+    answer, body = request(connection, '/one',
+                           headers=[('Transfer-Encoding', 'chunked')])
+
+    assert answer.status == 411
+    assert closed(connection)
@@ -0,0 +1,232 @@
+import hashlib
+import io
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+utils = pytest.importorskip('lbproxy.utils')
+
+import bottle  # noqa: E402
+
+TAG = utils.scope_tag('lb1', pool='/P1/a')
+
+app = bottle.Bottle()
+calls = []
+
+
+@app.get('/pool')
+@utils.conditional(tag=lambda: TAG)
+def pool():
+    calls.append(bottle.request.path)
+    return 'members'
+
+
+# Set to let the answers of /members through
+released = threading.Event()
+
+
+@app.get('/members')
+@utils.single_flight
+def members():
+    calls.append(bottle.request.get_header('Accept'))
+    number = len(calls)
+    released.wait(5)
+    if bottle.request.query.fail:
+        raise ValueError('failed')
+    return 'members %d' % number
+
+
+def call(path, headers=None):
+    """Answer one GET of app, return (status, {header: value}, body)"""
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+    }
+    for name, value in (headers or {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    answer = {}
+
+    def start_response(status, headers, exc_info=None):
+        answer['status'] = int(status.split()[0])
+        answer['headers'] = {name.lower(): value for name, value in headers}
+    body = b''.join(app(environ, start_response))
+    return answer['status'], answer['headers'], body
+
+
+@pytest.fixture
+def changed():
+    """Start the generations of the scopes and change the pool once"""
+    del calls[:]
+    utils.generation(TAG)
+    utils.bump_generations([TAG])
+
+
+def test_answers_carry_etag_and_vary(changed):
+    status, headers, body = call('/pool')
+
+    assert status == 200 and body == b'members'
+    assert headers['etag'].startswith('"') and headers['etag'].endswith('"')
+    assert headers['vary'] == 'Accept'
+    assert 'last-modified' in headers
+
+
+def test_matching_etag_is_answered_304(changed):
+    etag = call('/pool')[1]['etag']
+
+    status, headers, body = call('/pool', {'If-None-Match': etag})
+
+    assert status == 304 and body == b''
+    assert headers['etag'] == etag and headers['vary'] == 'Accept'
+    assert calls == ['/pool']
+
+
+def test_weak_and_listed_etags_match(changed):
+    etag = call('/pool')[1]['etag']
+
+    assert call('/pool', {'If-None-Match': 'W/' + etag})[0] == 304
+    assert call('/pool', {'If-None-Match': '"other", ' + etag})[0] == 304
+    assert call('/pool', {'If-None-Match': '*'})[0] == 304
+
+
+def test_every_variant_has_its_own_etag(changed):
+    json = call('/pool', {'Accept': 'application/json'})[1]['etag']
+    ndjson = call('/pool', {'Accept': 'application/x-ndjson'})[1]['etag']
+    query = call('/pool?details=1')[1]['etag']
+
+    assert len({json, ndjson, query}) == 3
+    assert call('/pool', {'Accept': 'application/x-ndjson',
+                          'If-None-Match': json})[0] == 200
+    assert call('/pool', {'Accept': 'application/x-ndjson',
+                          'If-None-Match': ndjson})[0] == 304
+
+
+def test_change_of_the_scope_moves_the_etag(changed):
+    etag = call('/pool')[1]['etag']
+
+    utils.invalidate_tags([TAG])
+
+    status, headers, body = call('/pool', {'If-None-Match': etag})
+    assert status == 200 and body == b'members'
+    assert headers['etag'] != etag
+
+
+def test_if_modified_since(changed):
+    modified = call('/pool')[1]['last-modified']
+    earlier = bottle.http_date(time.time() - 3600)
+
+    assert call('/pool', {'If-Modified-Since': modified})[0] == 304
+    assert call('/pool', {'If-Modified-Since': earlier})[0] == 200
+    # If-None-Match wins over If-Modified-Since
+    assert call('/pool', {'If-Modified-Since': modified,
+                          'If-None-Match': '"other"'})[0] == 200
+
+
+def test_answered_without_etag_until_generations_start():
+    del calls[:]
+
+    status, headers, body = call('/pool')
+
+    assert status == 200 and body == b'members'
+    assert 'etag' not in headers
+
+
+def test_recent_change_is_read_from_the_primary(changed):
+    from lbproxy import session
+
+    call('/pool')
+
+    assert session.info.get('force_primary') is True
+
+
+@pytest.fixture
+def flights():
+    del calls[:]
+    released.clear()
+    yield
+    released.set()
+
+
+def _concurrently(requests):
+    """Run call(*request) of every request at once, return the answers"""
+    answers = [None] * len(requests)
+
+    def run(i, request):
+        answers[i] = call(*request)
+    threads = [threading.Thread(target=run, args=(i, request))
+               for i, request in enumerate(requests)]
+    threads[0].start()
+    while not calls:
+        time.sleep(0.01)
+    for thread in threads[1:]:
+        thread.start()
+    # Let the followers find the flight of the first request
+    time.sleep(0.2)
+    released.set()
+    for thread in threads:
+        thread.join()
+    return answers
+
+
+def test_identical_requests_share_one_answer(flights):
+    answers = _concurrently([('/members',)] * 4)
+
+    assert calls == [None]
+    assert [(status, body) for status, headers, body in answers] == \
+        [(200, b'members 1')] * 4
+
+
+def test_requests_of_other_formats_are_answered_apart(flights):
+    answers = _concurrently([('/members', {'Accept': 'application/json'}),
+                             ('/members', {'Accept': 'text/plain'})])
+
+    assert sorted(calls) == ['application/json', 'text/plain']
+    assert {body for status, headers, body in answers} == \
+        {b'members 1', b'members 2'}
+
+
+def test_followers_share_the_error_of_the_leader(flights):
+    answers = _concurrently([('/members?fail=1',)] * 3)
+
+    assert calls == [None]
+    assert [status for status, headers, body in answers] == [500] * 3
+
+
+def test_single_flight_can_be_turned_off(flights, setting):
+    setting('single_flight', False)
+
+    answers = _concurrently([('/members',)] * 3)
+
+    assert calls == [None] * 3
+    assert sorted(body for status, headers, body in answers) == \
+        [b'members 1', b'members 2', b'members 3']
+
+
+def test_answer_of_another_worker_is_shared_through_redis(
+        flights, setting, redis):
+    setting('single_flight_redis', True)
+    key = ('GET', '/members', '', '')
+    lock = '%slock::%s' % (utils.flight_prefix, hashlib.md5(
+        repr(key).encode('utf-8')).hexdigest())
+    redis.set(lock, 'other', px=5000)
+    redis.set(utils.flight_prefix + 'other', json.dumps(
+        ['200 OK', 'text/plain', 'members of another worker']))
+
+    status, headers, body = call('/members')
+
+    assert calls == []
+    assert (status, body) == (200, b'members of another worker')
+
+
+def test_leader_takes_the_redis_lock(flights, setting, redis):
+    setting('single_flight_redis', True)
+    released.set()
+
+    assert call('/members')[2] == b'members 1'
+    assert calls == [None]
+    assert not redis.keys(utils.flight_prefix + 'lock::*')